@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the per-client x per-layer aggregation loop (deepcopy of the global model and
+one add_ per layer and client) with the flat running sum of StreamingAggregator used by
+the training loops, in every accumulation mode, on the MNIST NN and CIFAR10 CNN
+parameters.
+
+python benchmarks/bench_aggregation.py --n_sampled 10 50 --repeat=5
+"""
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import config
+
+config.USE_GPU = False
+
+from torch.nn.utils import parameters_to_vector
+from fedprox_func import StreamingAggregator, unflatten_params
+from models import NN, CNN_CIFAR10_dropout
+
+
+def layer_loop(model, clients_params, weights_):
+    """Aggregation as the training loops did it before the flat aggregator"""
+    layered = [unflatten_params(params, model) for params in clients_params]
+    new_model = deepcopy(model)
+    for layer_weights in new_model.parameters():
+        layer_weights.data.sub_(sum(weights_) * layer_weights.data)
+    for k, client_hist in enumerate(layered):
+        for idx, layer_weights in enumerate(new_model.parameters()):
+            layer_weights.data.add_(client_hist[idx].data * weights_[k])
+    return new_model
+
+
+def streaming(model, clients_params, weights_, accumulation):
+    aggregator = StreamingAggregator(model, global_weight=1 - sum(weights_), accumulation=accumulation)
+    for params, weight in zip(clients_params, weights_):
+        aggregator.add(params, weight)
+    aggregator.write(model)
+    return model
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_sampled', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for model_name, model in [('NN(50)', NN(50, 10)), ('CNN_CIFAR10_dropout', CNN_CIFAR10_dropout())]:
+        global_params = parameters_to_vector(model.parameters()).detach()
+        print(f"{model_name}: {global_params.numel()} parameters")
+        for n_sampled in args.n_sampled:
+            clients_params = [global_params + 0.01 * torch.randn_like(global_params) for _ in range(n_sampled)]
+            weights_ = [1 / n_sampled] * n_sampled
+
+            reference = parameters_to_vector(layer_loop(model, clients_params, weights_).parameters()).detach()
+            loop_seconds = best_of(args.repeat, lambda: layer_loop(model, clients_params, weights_))
+            print(f"  n_sampled={n_sampled:<4} layer loop: {loop_seconds * 1000:8.2f} ms")
+
+            for accumulation in ['fp32', 'fp64', 'kahan']:
+                result = parameters_to_vector(
+                    streaming(deepcopy(model), clients_params, weights_, accumulation).parameters()).detach()
+                max_error = float((reference - result).abs().max())
+
+                scratch = deepcopy(model)
+                stream_seconds = best_of(args.repeat, lambda: streaming(scratch, clients_params, weights_, accumulation))
+                print(f"    streaming {accumulation:<5}: {stream_seconds * 1000:8.2f} ms  "
+                      f"speedup: {loop_seconds / stream_seconds:5.2f}x  max |diff|: {max_error:.2e}")
+
+
+if __name__ == "__main__":
+    main()
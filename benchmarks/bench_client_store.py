@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput of local training (on the full data and after local data sampling), gradient
+probing and evaluation when the client data is served by per-client DataLoaders versus
+the contiguous client store (config.CLIENT_STORE).
+The synthetic dataset returns one sample per __getitem__ call, like the torchvision
+datasets, but skips image decoding, so the DataLoader numbers are an upper bound.
+
+python benchmarks/bench_client_store.py --n_clients=20 --shard=600 --repeat=3
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import torch.optim as optim
+import config
+
+config.USE_GPU = False
+config.BATCH_PREFETCH = 0
+
+from utils import BatchStream, build_client_store, client_gradient, local_data_sampling, loss_classifier
+from fedprox_func import accuracy_dataset, local_learning, loss_dataset
+from models import NN, CNN_CIFAR10_dropout
+
+
+class SampleDataset(torch.utils.data.Dataset):
+    """Per-sample indexed dataset, as returned by torchvision"""
+
+    def __init__(self, features, labels):
+        self.features, self.labels = features, labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return self.features[idx], int(self.labels[idx])
+
+
+def client_loaders(shape, n_clients, shard, batch_size):
+    features = torch.randn(n_clients * shard, *shape)
+    labels = torch.randint(0, 10, (n_clients * shard,))
+    dataset = SampleDataset(features, labels)
+    return [
+        torch.utils.data.DataLoader(
+            torch.utils.data.Subset(dataset, range(k * shard, (k + 1) * shard)),
+            batch_size=batch_size, shuffle=True,
+        )
+        for k in range(n_clients)
+    ]
+
+
+def best_of(repeat, fn):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def stages(model, loaders, n_SGD):
+    def train():
+        for k, dl in enumerate(loaders):
+            local_model = NN(50, 10) if isinstance(model, NN) else CNN_CIFAR10_dropout()
+            local_model.load_state_dict(model.state_dict())
+            optimizer = optim.SGD(local_model.parameters(), lr=0.01)
+            stream = BatchStream(dl.dataset, dl.batch_size, seed=k)
+            local_learning(local_model, 0.0, optimizer, stream, n_SGD, loss_classifier)
+
+    def sample():
+        # local data sampling of the dp/comp_grads schemes, then training on the sample
+        for k, dl in enumerate(loaders):
+            sampled = local_data_sampling(dl, len(dl.dataset) // 2, len(dl.dataset))
+            local_model = NN(50, 10) if isinstance(model, NN) else CNN_CIFAR10_dropout()
+            local_model.load_state_dict(model.state_dict())
+            optimizer = optim.SGD(local_model.parameters(), lr=0.01)
+            stream = BatchStream(sampled, dl.batch_size, seed=k)
+            local_learning(local_model, 0.0, optimizer, stream, n_SGD, loss_classifier)
+
+    def probe():
+        for dl in loaders:
+            client_gradient(model, dl)
+
+    def evaluate():
+        with torch.no_grad():
+            for dl in loaders:
+                loss_dataset(model, dl, loss_classifier)
+                accuracy_dataset(model, dl)
+
+    return {'train': train, 'sample': sample, 'probe': probe, 'evaluate': evaluate}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_clients', type=int, default=20)
+    parser.add_argument('--shard', type=int, default=600, help="Samples per client.")
+    parser.add_argument('--batch_size', type=int, default=50)
+    parser.add_argument('--n_SGD', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for model_name, model, shape in [('NN(50)', NN(50, 10), (1, 28, 28)),
+                                     ('CNN_CIFAR10_dropout', CNN_CIFAR10_dropout(), (3, 32, 32))]:
+        loaders = client_loaders(shape, args.n_clients, args.shard, args.batch_size)
+        start = time.perf_counter()
+        store = build_client_store(loaders)
+        build_seconds = time.perf_counter() - start
+        print(f"{model_name}: {args.n_clients} clients x {args.shard} samples, "
+              f"store built in {build_seconds * 1000:.1f} ms")
+
+        samples = {
+            'train': args.n_clients * args.n_SGD * args.batch_size,
+            'sample': args.n_clients * args.n_SGD * args.batch_size,
+            'probe': args.n_clients * args.shard,
+            'evaluate': 2 * args.n_clients * args.shard,
+        }
+        loader_stages, store_stages = stages(model, loaders, args.n_SGD), stages(model, store, args.n_SGD)
+        for stage in ['train', 'sample', 'probe', 'evaluate']:
+            loader_seconds = best_of(args.repeat, loader_stages[stage])
+            store_seconds = best_of(args.repeat, store_stages[stage])
+            print(f"  {stage:<9} DataLoader: {samples[stage] / loader_seconds:10.0f} samples/s  "
+                  f"store: {samples[stage] / store_seconds:10.0f} samples/s  "
+                  f"speedup: {loader_seconds / store_seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
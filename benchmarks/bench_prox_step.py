@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-step latency of a local FedProx SGD step with the proximal term added to the batch
+loss (optim.SGD, as local_learning did before FedProxSGD) versus applied in the step by
+FedProxSGD, for mu = 0 (FedAvg) and mu > 0, on the MNIST NN and CIFAR10 CNN.
+
+python benchmarks/bench_prox_step.py --mu 0 0.1 --steps=50 --repeat=5
+"""
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+import torch.optim as optim
+import config
+
+config.USE_GPU = False
+
+from torch.nn.utils import parameters_to_vector
+from fedprox_func import FedProxSGD
+from utils import loss_classifier
+from models import NN, CNN_CIFAR10_dropout
+
+
+def loss_term_step(model, model_0, optimizer, features, labels, mu):
+    """One step of the former local_learning: proximal term in the loss, even for mu == 0"""
+    optimizer.zero_grad()
+    batch_loss = loss_classifier(model(features), labels)
+    tensor_1 = list(model.parameters())
+    tensor_2 = list(model_0.parameters())
+    norm = sum([torch.sum((tensor_1[i] - tensor_2[i]) ** 2) for i in range(len(tensor_1))])
+    batch_loss += mu / 2 * norm
+    batch_loss.backward()
+    optimizer.step()
+
+
+def optimizer_step(model, optimizer, features, labels):
+    optimizer.zero_grad()
+    loss_classifier(model(features), labels).backward()
+    optimizer.step()
+
+
+def per_step(repeat, steps, fn):
+    fn()  # warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(steps):
+            fn()
+        times.append((time.perf_counter() - start) / steps)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mu', type=float, nargs='+', default=[0.0, 0.1])
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=50)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for model_name, model, shape in [('NN(50)', NN(50, 10), (1, 28, 28)),
+                                     ('CNN_CIFAR10_dropout', CNN_CIFAR10_dropout(), (3, 32, 32))]:
+        features = torch.randn(args.batch_size, *shape)
+        labels = torch.randint(0, 10, (args.batch_size,))
+        print(f"{model_name}: batch of {args.batch_size}")
+        for mu in args.mu:
+            old_model = deepcopy(model)
+            model_0 = deepcopy(model)
+            sgd = optim.SGD(old_model.parameters(), lr=0.01)
+            old_seconds = per_step(args.repeat, args.steps, lambda: loss_term_step(old_model, model_0, sgd, features, labels, mu))
+
+            new_model = deepcopy(model)
+            w0 = parameters_to_vector(model.parameters()).detach().clone()
+            fedprox = FedProxSGD(new_model.parameters(), lr=0.01, mu=mu, w0=w0)
+            new_seconds = per_step(args.repeat, args.steps, lambda: optimizer_step(new_model, fedprox, features, labels))
+
+            print(f"  mu={mu:<5} loss term: {old_seconds * 1e6:8.1f} us/step  "
+                  f"FedProxSGD: {new_seconds * 1e6:8.1f} us/step  speedup: {old_seconds / new_seconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compare the MiniBatchKMeans gradient compression with the histogram quantizer on
+synthetic gradients shaped like the MNIST NN and CIFAR10 CNN parameters.
+
+python benchmarks/bench_quantizer.py --d_prime=10 --repeat=3
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+import config
+from utils import compress_gradient
+from models import NN, CNN_CIFAR10_dropout
+
+config.USE_GPU = False
+
+
+def synthetic_gradient(model, scale):
+    """Heavy-tailed per-layer gradient with the parameter shapes of `model`"""
+    laplace = torch.distributions.Laplace(0.0, 1e-3)
+    layers = [laplace.sample(param.shape) for param in model.parameters()]
+    if scale > 1:
+        layers = [layer.repeat(scale, *([1] * (layer.dim() - 1))) for layer in layers]
+    return layers
+
+
+def quantization_error(layers, centers, indices):
+    flat = torch.cat([layer.flatten() for layer in layers]).double().numpy()
+    return float(np.sum((flat - centers[indices.astype(np.int64)]) ** 2))
+
+
+def run_backend(name, layers, d_prime, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if name == 'kmeans':
+            config.COMPRESSION = 'kmeans'
+            centers, indices = compress_gradient(torch.cat([l.flatten() for l in layers]), d_prime)
+        elif name == 'quantizer (flat)':
+            config.COMPRESSION = 'quantizer'
+            centers, indices = compress_gradient(torch.cat([l.flatten() for l in layers]), d_prime)
+        else:
+            config.COMPRESSION = 'quantizer'
+            centers, indices = compress_gradient(layers, d_prime)
+        times.append(time.perf_counter() - start)
+    return min(times), quantization_error(layers, centers, indices), indices.nbytes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--d_prime', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scale', type=int, default=1, help="Repeat every layer `scale` times to emulate larger models.")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for model_name, model in [('NN(50)', NN(50, 10)), ('CNN_CIFAR10_dropout', CNN_CIFAR10_dropout())]:
+        layers = synthetic_gradient(model, args.scale)
+        n_params = sum(layer.numel() for layer in layers)
+        print(f"{model_name}: {n_params} parameters, d_prime={args.d_prime}")
+        for backend in ['kmeans', 'quantizer (flat)', 'quantizer (streaming)']:
+            seconds, sse, index_bytes = run_backend(backend, layers, args.d_prime, args.repeat)
+            print(f"  {backend:<22} time: {seconds * 1000:9.2f} ms  SSE: {sse:.6e}  index bytes: {index_bytes}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Probe compression cost and geometry of the quantizer centers versus the count-sketch and
+Gaussian random-projection sketches, on synthetic client gradients drawn around
+`n_groups` group directions with the MNIST NN and CIFAR10 CNN parameter shapes.
+Geometry: correlation of the pairwise client distances after compression with the true
+ones, and adjusted Rand index of the k-means strata against the true groups.
+
+python benchmarks/bench_sketch.py --n_clients=40 --n_groups=4 --d_prime=10 --sketch_dim=128
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+import config
+
+config.USE_GPU = False
+
+from scipy.spatial.distance import pdist
+from sklearn.cluster import KMeans
+from sklearn.metrics import adjusted_rand_score
+from utils import compress_gradient
+from models import NN, CNN_CIFAR10_dropout
+
+
+def client_gradients(model, n_clients, n_groups):
+    """Per-layer gradients: a group direction plus client noise of the same magnitude"""
+    shapes = [param.shape for param in model.parameters()]
+    groups = [[torch.randn(shape) * 1e-3 for shape in shapes] for _ in range(n_groups)]
+    labels = np.arange(n_clients) % n_groups
+    grads = [[g + torch.randn(g.shape) * 1e-3 for g in groups[label]] for label in labels]
+    return grads, labels
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_clients', type=int, default=40)
+    parser.add_argument('--n_groups', type=int, default=4)
+    parser.add_argument('--d_prime', type=int, default=10)
+    parser.add_argument('--sketch_dim', type=int, default=128)
+    args = parser.parse_args()
+
+    config.SKETCH_DIM = args.sketch_dim
+    torch.manual_seed(0)
+    for model_name, model in [('NN(50)', NN(50, 10)), ('CNN_CIFAR10_dropout', CNN_CIFAR10_dropout())]:
+        grads, labels = client_gradients(model, args.n_clients, args.n_groups)
+        true_distances = pdist(np.stack([torch.cat([g.flatten() for g in grad]).numpy() for grad in grads]))
+        print(f"{model_name}: {sum(p.numel() for p in model.parameters())} parameters, "
+              f"{args.n_clients} clients in {args.n_groups} groups")
+
+        for name, compression, backend in [('quantizer centers', 'quantizer', None),
+                                           ('countsketch', 'sketch', 'countsketch'),
+                                           ('gaussian', 'sketch', 'gaussian')]:
+            config.COMPRESSION = compression
+            if backend is not None:
+                config.SKETCH_BACKEND = backend
+                compress_gradient(grads[0], args.d_prime)  # warm the shared hash cache
+            start = time.perf_counter()
+            compressed = np.stack([compress_gradient(grad, args.d_prime)[0] for grad in grads])
+            seconds = (time.perf_counter() - start) / args.n_clients
+
+            correlation = np.corrcoef(pdist(compressed), true_distances)[0, 1]
+            strata = KMeans(n_clusters=args.n_groups, n_init=10, random_state=0).fit_predict(compressed)
+            print(f"  {name:<18} dim: {compressed.shape[1]:4d}  time/client: {seconds * 1000:8.2f} ms  "
+                  f"distance corr: {correlation:6.3f}  ARI: {adjusted_rand_score(labels, strata):6.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the FedSTaS hot paths on synthetic client tensors, no dataset needed.
+Every case is timed `repeat` times after a warm-up and reported as machine-readable JSON
+(median and min seconds per call). With --compare, the medians are checked against a
+stored baseline and every case slower by more than --threshold is flagged as a
+regression (exit status 1). Runs with different workload parameters are not compared
+(exit status 2).
+
+python benchmarks/bench_suite.py --output=baseline.json
+python benchmarks/bench_suite.py --compare=baseline.json --threshold=0.1
+python benchmarks/bench_suite.py --cases estimator aggregation --repeat=10
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+import config
+
+config.USE_GPU = False
+config.BATCH_PREFETCH = 0
+
+from torch.nn.utils import parameters_to_vector
+from utils import (BatchStream, Estimator, IncrementalStratifier, cal_allocation_number_NS,
+                   client_compress_gradient, collect_compressed_gradients, local_data_sampling,
+                   loss_classifier, sample_clients_stratified, strata_from_labels)
+from fedprox_func import (ClientEvaluator, LocalModelPool, StreamingAggregator, local_learning,
+                          stratify_clients_compressed_gradients)
+from models import NN, CNN_CIFAR10_dropout
+
+
+def client_loaders(shape, n_clients, shard, batch_size=50, shuffle=True):
+    features = torch.randn(n_clients * shard, *shape)
+    labels = torch.randint(0, 10, (n_clients * shard,))
+    dataset = torch.utils.data.TensorDataset(features, labels)
+    return [
+        torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, range(k * shard, (k + 1) * shard)),
+                                    batch_size=batch_size, shuffle=shuffle)
+        for k in range(n_clients)
+    ]
+
+
+def case_client_compress_gradient(args):
+    model, loader = NN(50, 10), client_loaders((1, 28, 28), 1, args.shard)[0]
+    return lambda: client_compress_gradient(model, loader, args.d_prime)
+
+
+def case_collect_compressed_gradients(args):
+    model, loaders = NN(50, 10), client_loaders((1, 28, 28), args.n_clients, args.shard)
+    return lambda: collect_compressed_gradients(model, loaders, args.d_prime)
+
+
+def _probe_matrix(args):
+    # clustered centers, like the compressed gradients of clients with similar data
+    groups = np.random.randn(args.strata_num, args.d_prime)
+    labels = np.arange(args.n_population) % args.strata_num
+    return groups[labels] + 0.1 * np.random.randn(args.n_population, args.d_prime), labels
+
+
+def case_stratify_clients_compressed_gradients(args):
+    compressed_grads, _ = _probe_matrix(args)
+    namespace = SimpleNamespace(strata_num=args.strata_num, dataset='synthetic', partition='bench')
+    return lambda: stratify_clients_compressed_gradients(namespace, compressed_grads)
+
+
+def case_stratify_clients_compressed_gradients_warm(args):
+    # as with STRATIFY_WARM_START: one stratifier across rounds, the sketches drifting a little
+    compressed_grads, _ = _probe_matrix(args)
+    rounds = [compressed_grads + 0.01 * np.random.randn(*compressed_grads.shape) for _ in range(4)]
+    namespace = SimpleNamespace(strata_num=args.strata_num, dataset='synthetic', partition='bench')
+    stratifier = IncrementalStratifier(args.strata_num)
+    stratifier.fit_predict(compressed_grads)  # the cold KMeans fit of the first round
+    state = {'round': 0}
+
+    def run():
+        state['round'] += 1
+        stratify_clients_compressed_gradients(namespace, rounds[state['round'] % len(rounds)], stratifier)
+    return run
+
+
+def case_cal_allocation_number_NS(args):
+    compressed_grads, labels = _probe_matrix(args)
+    stratify_result = strata_from_labels(labels, args.strata_num)
+    sizes = [len(stratum) for stratum in stratify_result]
+    return lambda: cal_allocation_number_NS(stratify_result, compressed_grads, sizes, 0.1)
+
+
+def case_sample_clients_stratified(args):
+    _, labels = _probe_matrix(args)
+    strata = strata_from_labels(labels, args.strata_num)
+    client_grad_norms = np.random.rand(args.n_population)
+    allocation_number = np.full(args.strata_num, args.n_population // (10 * args.strata_num))
+    return lambda: sample_clients_stratified(strata, client_grad_norms, allocation_number)
+
+
+def case_estimator(args):
+    sizes = np.random.randint(1, 2000, args.n_population)
+    estimator = Estimator({k: range(size) for k, size in enumerate(sizes)}, alpha=0.5, M=1000, seed=0)
+    return estimator.estimate
+
+
+def case_local_data_sampling(args):
+    loader = client_loaders((1, 28, 28), 1, 60000)[0]
+    return lambda: local_data_sampling(loader, 30000, 60000)
+
+
+def case_local_learning(args):
+    # as _train_job: pooled model and FedProxSGD reset from the flat global weights
+    global_model = NN(50, 10)
+    loader = client_loaders((1, 28, 28), 1, args.shard)[0]
+    stream = BatchStream(loader.dataset, loader.batch_size, seed=0)
+    w0 = parameters_to_vector(global_model.parameters()).detach().clone()
+    model_pool = LocalModelPool(global_model)
+
+    def run():
+        model, optimizer = model_pool.acquire(w0, 0.01)
+        local_learning(model, 0.1, optimizer, stream, args.n_SGD, loss_classifier, w0=w0)
+        model_pool.release(model, optimizer)
+    return run
+
+
+def case_aggregation(args):
+    model = CNN_CIFAR10_dropout()
+    current = parameters_to_vector(model.parameters()).detach()
+    updates = [current + 0.01 * torch.randn_like(current) for _ in range(args.n_clients)]
+
+    def run():
+        aggregator = StreamingAggregator(model)
+        for update in updates:
+            aggregator.add(update, 1 / len(updates))
+        aggregator.write(model)
+    return run
+
+
+def case_evaluation(args):
+    # an intermediate round of the FedProx_* loops, every client evaluated on its test set
+    model = NN(50, 10)
+    training_sets = client_loaders((1, 28, 28), args.n_clients, args.shard, shuffle=False)
+    testing_sets = client_loaders((1, 28, 28), args.n_clients, args.shard // 6, shuffle=False)
+    weights = np.full(args.n_clients, 1 / args.n_clients)
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter=2, every=1, clients='all', seed=0)
+    loss_hist, acc_hist = np.zeros((3, args.n_clients)), np.zeros((3, args.n_clients))
+    return lambda: evaluator.evaluate(model, loss_hist, acc_hist, 1)
+
+
+CASES = {
+    'client_compress_gradient': case_client_compress_gradient,
+    'collect_compressed_gradients': case_collect_compressed_gradients,
+    'stratify_clients_compressed_gradients': case_stratify_clients_compressed_gradients,
+    'stratify_clients_compressed_gradients_warm': case_stratify_clients_compressed_gradients_warm,
+    'cal_allocation_number_NS': case_cal_allocation_number_NS,
+    'sample_clients_stratified': case_sample_clients_stratified,
+    'estimator': case_estimator,
+    'local_data_sampling': case_local_data_sampling,
+    'local_learning': case_local_learning,
+    'aggregation': case_aggregation,
+    'evaluation': case_evaluation,
+}
+
+
+def time_case(fn, repeat):
+    fn()  # warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'median_s': float(np.median(times)), 'min_s': float(np.min(times)), 'repeat': repeat}
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every case against `baseline`, return the regressed cases"""
+    regressions = []
+    for name, result in results['cases'].items():
+        if name not in baseline['cases']:
+            print(f"  {name:<44} {result['median_s'] * 1000:10.3f} ms  (not in baseline)")
+            continue
+        reference = baseline['cases'][name]['median_s']
+        change = result['median_s'] / reference - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"  {name:<44} {reference * 1000:10.3f} ms -> {result['median_s'] * 1000:10.3f} ms  "
+              f"{change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', type=str, nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--n_clients', type=int, default=20, help="Clients probed, trained or evaluated.")
+    parser.add_argument('--n_population', type=int, default=10000, help="Clients stratified and sampled.")
+    parser.add_argument('--shard', type=int, default=600, help="Samples per client.")
+    parser.add_argument('--strata_num', type=int, default=10)
+    parser.add_argument('--d_prime', type=int, default=10)
+    parser.add_argument('--n_SGD', type=int, default=50)
+    parser.add_argument('--output', type=str, default=None, help="Write the results as JSON to this file.")
+    parser.add_argument('--compare', type=str, default=None, help="Baseline JSON to compare against.")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Relative slowdown flagged as a regression.")
+    args = parser.parse_args()
+
+    results = {
+        'meta': {
+            'python': platform.python_version(), 'torch': torch.__version__, 'numpy': np.__version__,
+            'machine': platform.machine(), 'threads': torch.get_num_threads(),
+            'params': {key: value for key, value in vars(args).items()
+                       if key not in ('cases', 'output', 'compare', 'threshold')},
+        },
+        'cases': {},
+    }
+
+    # stratify_clients_compressed_gradients saves its strata under dataset/, keep them out of the tree
+    with tempfile.TemporaryDirectory() as scratch:
+        os.makedirs(os.path.join(scratch, 'dataset', 'stratify_result'))
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        stdout = sys.stdout
+        try:
+            for name in args.cases:
+                torch.manual_seed(0)
+                np.random.seed(0)
+                fn = CASES[name](args)
+                sys.stdout = open(os.devnull, 'w')  # the hot paths print their progress
+                try:
+                    results['cases'][name] = time_case(fn, args.repeat)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                print(f"  {name:<44} {results['cases'][name]['median_s'] * 1000:10.3f} ms", file=sys.stderr)
+        finally:
+            os.chdir(cwd)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare is None:
+        if args.output is None:
+            print(json.dumps(results, indent=2))
+        return
+
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)
+    baseline_params = baseline['meta']['params']
+    # the number of timings does not change the workload
+    mismatched = {key: (baseline_params.get(key), value) for key, value in results['meta']['params'].items()
+                  if key != 'repeat' and baseline_params.get(key) != value}
+    if mismatched:
+        print(f"Not comparing with {args.compare}, the workloads differ (baseline, current): "
+              + ", ".join(f"{key}={old} vs {new}" for key, (old, new) in mismatched.items()))
+        sys.exit(2)
+    print(f"Comparison with {args.compare} (threshold {args.threshold:.0%}):")
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+    print("No regression.")
+
+
+if __name__ == "__main__":
+    main()
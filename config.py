@@ -1,3 +1,100 @@
 USE_GPU = True
 
 WITH_ALLOCATION = True
+
+# Gradient probe: compute every client's averaged gradient with one vmapped
+# forward/backward pass per step over PROBE_CHUNK clients (needs torch.func).
+# Off by default: on CPU the vmapped probe is about 1.5x slower than the sequential one
+# on the CIFAR10 CNN (vmapped convolutions) and no faster on the MNIST NN, so only turn
+# it on where it is measured to win, e.g. on GPU
+BATCHED_PROBE = False
+PROBE_CHUNK = 16
+
+# Gradient probe batches: 'full' averages each client's gradient over its whole loader,
+# 'fixed' over the same PROBE_MAX_BATCHES batches of the client every round, 'random'
+# over PROBE_MAX_BATCHES batches redrawn every round, and 'adaptive' over random batches
+# until one moves the running mean by at most PROBE_TOL (relative L2), at most
+# PROBE_MAX_BATCHES of them
+PROBE_MODE = 'full'
+PROBE_MAX_BATCHES = 10
+PROBE_TOL = 0.05
+
+# Gradient probe layers: 'all' backpropagates through the whole model, 'last' computes
+# only the output layer's (fc2) gradient in closed form from one forward pass per batch
+PROBE_LAYER = 'all'
+
+# Gradient compression backend: 'quantizer' (exact histogram-based 1-D k-means,
+# deterministic, sorted codebook), 'kmeans' (sklearn MiniBatchKMeans) or 'sketch'
+# (SKETCH_DIM-dimensional random sketch of the gradient, streamed layer by layer, with
+# the SKETCH_SEED shared by all clients: 'countsketch' hashes every coordinate into a
+# signed bucket, 'gaussian' projects on a Gaussian matrix; d_prime is not used)
+COMPRESSION = 'quantizer'
+QUANTIZER_BINS = 1024
+SKETCH_BACKEND = 'countsketch'
+SKETCH_DIM = 128
+SKETCH_SEED = 0
+
+# Wire format of the compressed gradients: codebook dtype ('float32' or 'float16'),
+# center indices are bit-packed on ceil(log2 d_prime) bits
+CODEBOOK_DTYPE = 'float32'
+
+# Local training: number of forked worker processes running the sampled clients
+# of a round in parallel (0 trains them one after another in-process)
+N_WORKERS = 0
+
+# Local training draws its batches from a persistent per-client BatchStream; a
+# background thread prepares the next BATCH_PREFETCH batches (0 disables it)
+BATCH_PREFETCH = 2
+
+# In-process local training: train TRAINING_CHUNK sampled clients at a time with one
+# vmapped functional model over their stacked parameters (needs torch.func)
+BATCHED_TRAINING = False
+TRAINING_CHUNK = 16
+
+# Materialize every client's train and test shard once as contiguous tensors (on the
+# GPU with USE_GPU) and serve batches by slicing instead of through DataLoaders
+CLIENT_STORE = False
+
+# Aggregation: client updates are folded into a running sum as they arrive, in fp32,
+# 'fp64' or with 'kahan' compensated summation; AGGREGATION_WEIGHTS selects the
+# weights of the compressed-gradient scheme, 'uniform' (1/n_sampled) or 'proposed'
+# (calculate_aggregation_weights)
+AGGREGATION_ACCUMULATION = 'fp32'
+AGGREGATION_WEIGHTS = 'uniform'
+
+# Evaluation: batches of consecutive clients are concatenated into forward passes of
+# about EVAL_CHUNK samples
+EVAL_CHUNK = 4096
+
+# Evaluation policy: evaluate every EVAL_EVERY rounds (the initial model and the final
+# round always are); EVAL_CLIENTS = 'all', 'random' or 'stratified' evaluates all the
+# clients or an EVAL_FRACTION of them, estimating the server metrics with a standard
+# error. Skipped rounds and clients are NaN in the saved loss/acc histories
+EVAL_EVERY = 1
+EVAL_CLIENTS = 'all'
+EVAL_FRACTION = 0.2
+EVAL_STRATA = 10
+
+# Gradient sketch cache for the per-round stratification:
+# 'all' re-probes every client every round, 'sampled' only the clients sampled in the
+# previous round, 'every' all clients every SKETCH_REFRESH_EVERY rounds, 'fraction' a
+# random SKETCH_REFRESH_FRACTION of the clients each round
+SKETCH_REFRESH = 'all'
+SKETCH_REFRESH_EVERY = 5
+SKETCH_REFRESH_FRACTION = 0.2
+
+# Per-round stratification: warm-start k-means from last round's centroids with at
+# most STRATIFY_MAX_ITER Lloyd iterations, keeping stratum ids stable across rounds
+STRATIFY_WARM_START = True
+STRATIFY_MAX_ITER = 10
+
+# Neyman allocation: strata with more than NEYMAN_EXACT_MAX clients estimate S_h from
+# random client pairs, within NEYMAN_EPS * diameter with probability 1 - NEYMAN_DELTA
+NEYMAN_EXACT_MAX = 5000
+NEYMAN_EPS = 0.01
+NEYMAN_DELTA = 0.01
+
+# Round timing: every run saves the wall and CPU time of each stage of each round to
+# saved_exp_info/timing; TIMING_TRACE also exports the round timeline as a Chrome
+# trace-event JSON next to it
+TIMING_TRACE = False
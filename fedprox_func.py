@@ -8,9 +8,12 @@ import torch.optim as optim
 import numpy as np
 import random
 import config
+from numpy.random import choice
+import torch.multiprocessing as mp
 from utils import *
 from copy import deepcopy
 from torch.autograd import Variable
+from torch.nn.utils import parameters_to_vector
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, confusion_matrix
 
 if config.USE_GPU:
@@ -24,30 +27,28 @@ def get_variable(x):
     return x.cuda() if config.USE_GPU else x
     # requires_grad=True with tensor x in newer PyTorch versions
 
-def stratify_clients_compressed_gradients(args, compressed_grads):
+def stratify_clients_compressed_gradients(args, compressed_grads, stratifier=None):
     """
     Args:
         args: Arguments
         compressed_grads: Compressed gradients from clients
+        stratifier: optional IncrementalStratifier keeping the strata stable across rounds
     """
     # Uses compressed gradients directly - no need for PCA
     data = compressed_grads
     print("Shape of compressed gradients:", data.shape)
 
     # Prototype Based Clustering: KMeans
-    model = KMeans(n_clusters=args.strata_num)
-    model.fit(data)
-    pred_y = model.predict(data)
-    pred_y = list(pred_y)
-    result = []
-    
+    if stratifier is not None:
+        pred_y = stratifier.fit_predict(data)
+        print(f"Clients that changed stratum: {stratifier.churn:.2%}")
+    else:
+        model = KMeans(n_clusters=args.strata_num)
+        model.fit(data)
+        pred_y = model.predict(data)
+
     # put indexes into result
-    for num in range(args.strata_num):
-        one_type = []
-        for index, value in enumerate(pred_y):
-            if value == num:
-                one_type.append(index)
-        result.append(one_type)
+    result = strata_from_labels(pred_y, args.strata_num)
     print("Stratification result:", result)
     
     save_path = f'dataset/stratify_result/{args.dataset}_{args.partition}.pkl'
@@ -60,6 +61,7 @@ def stratify_clients_compressed_gradients(args, compressed_grads):
     
     return result
 
+@inference_mode()
 def accuracy_dataset(model, dataset):
     """Compute the accuracy {}% of `model` on `test_data`"""
 
@@ -79,6 +81,7 @@ def accuracy_dataset(model, dataset):
 
     return accuracy
 
+@inference_mode()
 def loss_dataset(model, train_data, loss_classifier):
     """Compute the loss of `model` on `test_data`"""
     loss = 0
@@ -93,12 +96,239 @@ def loss_dataset(model, train_data, loss_classifier):
     loss /= idx + 1 #average loss, idx is batch index
     return loss
 
-def local_learning(model, mu: float, optimizer, train_data, n_SGD: int, loss_classifier):
-    model_0 = deepcopy(model)
+@inference_mode()
+def evaluate_clients(model, datasets: list, chunk_size=None):
+    """
+    Loss and accuracy {}% of `model` on every dataset of `datasets`, in a single pass.
+    The batches of consecutive clients are concatenated into chunks of about chunk_size
+    samples, each sent through one forward pass; per-sample losses and hits are then
+    summed per batch and per client with index_add_. As in loss_dataset, the loss of a
+    client is the mean of its batch losses, and as in accuracy_dataset its accuracy is
+    the share of its samples that are well classified.
+    Returns two arrays of length len(datasets).
+    """
+    if chunk_size is None:
+        chunk_size = config.EVAL_CHUNK
+    device = next(model.parameters()).device
+    batch_losses = torch.zeros(len(datasets), dtype=torch.float64, device=device)
+    n_batches = torch.zeros(len(datasets), dtype=torch.float64, device=device)
+    correct = torch.zeros(len(datasets), dtype=torch.float64, device=device)
+
+    def reduce_chunk(batches, owners):
+        features = get_variable(torch.cat([b[0] for b in batches]))
+        labels = get_variable(torch.cat([b[1] for b in batches]))
+        sizes = torch.tensor([len(b[1]) for b in batches], device=device)
+        batch_of = torch.repeat_interleave(torch.arange(len(batches), device=device), sizes)
+        owners = torch.tensor(owners, device=device)
+
+        predictions = model(features)
+        losses = F.cross_entropy(predictions, labels, reduction='none').double()
+        hits = (predictions.argmax(1) == labels).double()
+
+        batch_loss = torch.zeros(len(batches), dtype=torch.float64, device=device)
+        batch_loss.index_add_(0, batch_of, losses)
+        batch_losses.index_add_(0, owners, batch_loss / sizes)
+        n_batches.index_add_(0, owners, torch.ones_like(batch_loss))
+        correct.index_add_(0, owners[batch_of], hits)
+
+    batches, owners, pending = [], [], 0
+    for k, dl in enumerate(datasets):
+        for batch in dl:
+            batches.append(batch)
+            owners.append(k)
+            pending += len(batch[1])
+            if pending >= chunk_size:
+                reduce_chunk(batches, owners)
+                batches, owners, pending = [], [], 0
+    if batches:
+        reduce_chunk(batches, owners)
+
+    sizes = np.array([len(dl.dataset) for dl in datasets])
+    losses = (batch_losses / n_batches.clamp(min=1)).cpu().numpy()
+    accuracies = 100 * correct.cpu().numpy() / np.maximum(sizes, 1)
+    return losses, accuracies
+
+def evaluate_round(model, loss_sets: list, acc_sets: list, loss_hist, acc_hist, row: int, clients=None):
+    """
+    Fill loss_hist[row] with the loss of `model` on every client of `loss_sets` and
+    acc_hist[row] with its accuracy on `acc_sets`, with one evaluate_clients pass.
+    With `clients` only those clients are evaluated and the others are set to NaN.
+    """
+    if clients is None:
+        clients = np.arange(len(loss_sets))
+    else:
+        loss_hist[row], acc_hist[row] = np.nan, np.nan
+    if loss_sets is acc_sets:
+        loss_hist[row, clients], acc_hist[row, clients] = evaluate_clients(model, [loss_sets[k] for k in clients])
+    else:
+        losses, accuracies = evaluate_clients(
+            model, [loss_sets[k] for k in clients] + [acc_sets[k] for k in clients]
+        )
+        loss_hist[row, clients], acc_hist[row, clients] = losses[:len(clients)], accuracies[len(clients):]
+
+def stratified_estimate(values, weights, strata, clients):
+    """
+    Estimate of sum_k weights[k] * values[k] over all the clients from the clients
+    `clients` only, drawn uniformly without replacement inside every stratum of `strata`.
+    Uses the stratified expansion estimator sum_h N_h * mean of weights * values over the
+    sampled clients of h, and returns it with its standard error (finite population
+    correction included; a stratum with a single sampled client adds no variance).
+    """
+    sampled = set(int(k) for k in clients)
+    estimate, variance = 0.0, 0.0
+    for stratum in strata:
+        y = np.array([weights[k] * values[k] for k in stratum if k in sampled])
+        n_h, N_h = len(y), len(stratum)
+        if n_h == 0:
+            continue
+        estimate += N_h * y.mean()
+        if n_h > 1:
+            variance += N_h ** 2 * (1 - n_h / N_h) * y.var(ddof=1) / n_h
+    return estimate, np.sqrt(variance)
+
+class ClientEvaluator:
+    """
+    Evaluation policy of a training run, applied by evaluate() after every round.
+    Rounds are evaluated every `every` rounds, always including the initial model and
+    the final round; skipped rounds are NaN in loss_hist/acc_hist. `clients` selects
+    who is evaluated in the intermediate rounds: 'all', 'random' (a uniform `fraction`
+    of the clients) or 'stratified' (the same fraction allocated proportionally over
+    strata, at least one client each: the training strata if given, else up to
+    EVAL_STRATA groups of clients of similar weight).
+    Clients that are not evaluated are NaN, and the printed server loss/accuracy is
+    then a stratified estimate with its standard error.
+    The initial model is evaluated on the training sets, as before any training.
+    """
+
+    def __init__(self, training_sets: list, testing_sets: list, weights, n_iter: int,
+                 every=None, clients=None, fraction=None, seed=None):
+        self.training_sets = training_sets
+        self.testing_sets = testing_sets
+        self.weights = weights
+        self.n_iter = n_iter
+        self.every = config.EVAL_EVERY if every is None else every
+        self.clients = config.EVAL_CLIENTS if clients is None else clients
+        self.fraction = config.EVAL_FRACTION if fraction is None else fraction
+        if seed is None:
+            seed = torch.initial_seed()
+        # own random stream, so the evaluation policy does not change the training
+        self.rng = np.random.default_rng([seed, 1])
+        self.history = {'round': [], 'loss': [], 'acc': [], 'loss_se': [], 'acc_se': [], 'n_clients': []}
+
+    def _select(self, strata):
+        K = len(self.training_sets)
+        n_eval = min(K, max(1, int(round(self.fraction * K))))
+        if self.clients == 'random':
+            strata = [np.arange(K)]
+        elif strata is None:
+            # groups of clients of similar weight, with two evaluated clients per group
+            order = np.argsort(self.weights, kind='stable')
+            strata = np.array_split(order, max(1, min(config.EVAL_STRATA, n_eval // 2)))
+        strata = [np.asarray(stratum, dtype=int) for stratum in strata if len(stratum) > 0]
+        sizes = np.array([len(stratum) for stratum in strata])
+        allocation = largest_remainder_allocation(sizes, n_eval, sizes)
+        allocation = np.minimum(np.maximum(allocation, 1), sizes)
+        clients = sample_clients_stratified(strata, np.ones(K), allocation, rng=self.rng)
+        return np.sort(clients), strata
+
+    def evaluate(self, model, loss_hist, acc_hist, row: int, strata=None):
+        """
+        Evaluate `model` after round `row` (0 for the initial model) following the policy.
+        Returns the server loss and accuracy, or None if the round is skipped.
+        """
+        if row not in (0, self.n_iter) and row % self.every != 0:
+            loss_hist[row], acc_hist[row] = np.nan, np.nan
+            return None
+
+        if row in (0, self.n_iter) or self.clients == 'all':
+            clients, strata = None, [np.arange(len(self.training_sets))]
+            sampled = np.arange(len(self.training_sets))
+        else:
+            sampled, strata = self._select(strata)
+            clients = sampled
+        acc_sets = self.training_sets if row == 0 else self.testing_sets
+        evaluate_round(model, self.training_sets, acc_sets, loss_hist, acc_hist, row, clients)
+
+        server_loss, loss_se = stratified_estimate(loss_hist[row], self.weights, strata, sampled)
+        server_acc, acc_se = stratified_estimate(acc_hist[row], self.weights, strata, sampled)
+        for key, value in zip(self.history, (row, server_loss, server_acc, loss_se, acc_se, len(sampled))):
+            self.history[key].append(float(value) if key.endswith(('loss', 'acc', 'se')) else int(value))
+
+        if clients is None:
+            print(f"====> i: {row} Loss: {server_loss} Server Test Accuracy: {server_acc}")
+        else:
+            print(f"====> i: {row} Loss: {server_loss} (SE {loss_se:.4f}) "
+                  f"Server Test Accuracy: {server_acc} (SE {acc_se:.4f}, {len(sampled)} clients)")
+        return server_loss, server_acc
+
+def _cycle(train_data):
+    while True:
+        yield from train_data
+
+class FedProxSGD(optim.Optimizer):
+    """
+    Plain SGD that applies the FedProx proximal gradient mu * (w - w0) in its step,
+    instead of adding mu/2 * ||w - w0||^2 to every batch loss.
+    w0 is a flat snapshot of the reference weights, only read through views shaped like
+    the parameters; with mu == 0 the step is exactly SGD and w0 is never touched.
+    """
+
+    def __init__(self, params, lr, mu=0.0, w0=None):
+        super().__init__(params, dict(lr=lr, mu=mu))
+        self.w0 = None
+        if w0 is not None:
+            self.set_proximal(mu, w0)
+
+    def set_proximal(self, mu, w0):
+        """Set mu and the flat reference weights w0 (may be None if mu == 0)"""
+        offset = 0
+        self.w0 = None if w0 is None else []
+        for group in self.param_groups:
+            group['mu'] = mu
+            for param in group['params']:
+                if w0 is not None:
+                    self.w0.append(w0[offset:offset + param.numel()].view_as(param))
+                offset += param.numel()
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        w0 = iter(self.w0 or [])
+        for group in self.param_groups:
+            for param in group['params']:
+                param_0 = next(w0, None)
+                if param.grad is None:
+                    continue
+                d_p = param.grad
+                if group['mu'] != 0:
+                    d_p = d_p.add(param - param_0, alpha=group['mu'])
+                param.add_(d_p, alpha=-group['lr'])
+        return loss
+
+def local_learning(model, mu: float, optimizer, train_data, n_SGD: int, loss_classifier, w0=None):
+    """
+    n_SGD FedProx steps of `model`. train_data is a BatchStream, or a DataLoader that is
+    then iterated epoch after epoch.
+    w0: flat snapshot of the weights of the proximal term, only read; defaults to the
+    current weights of `model`.
+    A FedProxSGD optimizer applies the proximal term in its step; any other optimizer
+    gets it added to the batch loss. Nothing is computed for it when mu == 0.
+    """
+    if w0 is None and mu != 0:
+        w0 = parameters_to_vector(model.parameters()).detach().clone()
+    proximal_step = isinstance(optimizer, FedProxSGD)
+    if proximal_step:
+        optimizer.set_proximal(mu, w0)
+    elif mu != 0:
+        params_0 = unflatten_params(w0, model)
+    batches = train_data if isinstance(train_data, BatchStream) else _cycle(train_data)
 
     for _ in range(n_SGD):
-        train_data_iter = iter(train_data)
-        features, labels = next(train_data_iter)
+        features, labels = next(batches)
 
         features = get_variable(features)
         labels = get_variable(labels)
@@ -109,19 +339,287 @@ def local_learning(model, mu: float, optimizer, train_data, n_SGD: int, loss_cla
 
         batch_loss = loss_classifier(predictions, labels)
         
-        tensor_1 = list(model.parameters())
-        tensor_2 = list(model_0.parameters())
-        norm = sum(
-            [
-                torch.sum((tensor_1[i] - tensor_2[i]) ** 2)
-                for i in range(len(tensor_1))
-            ]
-        )
-        batch_loss += mu / 2 * norm
+        if mu != 0 and not proximal_step:
+            tensor_1 = list(model.parameters())
+            norm = sum(
+                [
+                    torch.sum((tensor_1[i] - params_0[i]) ** 2)
+                    for i in range(len(tensor_1))
+                ]
+            )
+            batch_loss += mu / 2 * norm
         
         batch_loss.backward()
         optimizer.step()
 
+def unflatten_params(flat_params, model):
+    """Split a flat parameter vector into views shaped like the parameters of `model`"""
+    list_params = []
+    offset = 0
+    for param in model.parameters():
+        list_params.append(flat_params[offset:offset + param.numel()].view_as(param))
+        offset += param.numel()
+    return list_params
+
+def load_flat_params(model, flat_params):
+    """Copy a flat parameter vector into the parameters of `model`, in place"""
+    with torch.no_grad():
+        for param, values in zip(model.parameters(), unflatten_params(flat_params, model)):
+            param.copy_(values)
+
+class StreamingAggregator:
+    """
+    Running weighted sum of client updates, folded in as soon as each local training
+    finishes so that no client update outlives its own add() call.
+    The sum starts at global_weight * (parameters of `model`). accumulation is 'fp32',
+    'fp64' (double precision running sum) or 'kahan' (compensated fp32 summation);
+    config.AGGREGATION_ACCUMULATION by default.
+    """
+
+    def __init__(self, model, global_weight=0.0, accumulation=None):
+        if accumulation is None:
+            accumulation = config.AGGREGATION_ACCUMULATION
+        current = parameters_to_vector(model.parameters()).detach()
+        dtype = torch.float64 if accumulation == 'fp64' else current.dtype
+
+        self.accumulation = accumulation
+        self.total = current.to(dtype) * global_weight
+        self.compensation = torch.zeros_like(self.total) if accumulation == 'kahan' else None
+        self.n_contrib = 0
+
+    def add(self, params, weight):
+        contribution = params.to(self.total) * weight
+        if self.compensation is None:
+            self.total.add_(contribution)
+        else:
+            contribution.sub_(self.compensation)
+            new_total = self.total + contribution
+            self.compensation = (new_total - self.total).sub_(contribution)
+            self.total = new_total
+        self.n_contrib += 1
+
+    def write(self, model):
+        """Load the aggregated parameters into `model`, in place"""
+        load_flat_params(model, self.total)
+
+# Executor state of the current process; pool workers inherit it when they are forked
+_EXECUTOR_STATE = {}
+
+def _init_worker():
+    # one intra-op thread per worker, the parallelism comes from the pool
+    torch.set_num_threads(1)
+
+def _job_seed(base_seed, round_idx, position):
+    """Seed of the `position`-th local job of round `round_idx`"""
+    return int(np.random.SeedSequence([base_seed, round_idx, position]).generate_state(1)[0])
+
+def _job_stream(job, state, persistent=True):
+    """
+    Seed the random streams of `job` and return the BatchStream its client trains on.
+    K_desired is None to train on the full client data from position `step` of the
+    client's persistent batch stream (or of a new stream over the same batches if not
+    `persistent`), otherwise the client first samples its data with
+    local_data_sampling and gets a stream over it, or None if it sampled nothing.
+    """
+    k, seed, lr, K_desired, hatN, step = job
+
+    torch.manual_seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    random.seed(seed)
+
+    train_data = state['training_sets'][k]
+    if K_desired is None:
+        if not persistent:
+            return BatchStream(
+                train_data.dataset, train_data.batch_size, seed=(state['base_seed'], k), position=step
+            )
+        # the client's stream persists across rounds, resumed where the last round stopped
+        if k not in state['streams']:
+            state['streams'][k] = BatchStream(
+                train_data.dataset, train_data.batch_size, seed=(state['base_seed'], k)
+            )
+        stream = state['streams'][k]
+        stream.seek(step)
+        return stream
+
+    # local data sampling
+    sampled_dataset = local_data_sampling(train_data, K_desired, hatN)
+    if sampled_dataset is None:
+        return None
+    return BatchStream(sampled_dataset, train_data.batch_size, seed=seed)
+
+def _train_job(job):
+    """
+    Local FedProx update of one client, starting from the global weights in shared memory.
+    job = (client, seed, lr, K_desired, hatN, step), see _job_stream.
+    Returns the flat trained parameters.
+    """
+    lr = job[2]
+    state = _EXECUTOR_STATE
+    stream = _job_stream(job, state)
+    if stream is None:
+        # no data sampled, the client sends back the global model
+        return state['weights'].clone()
+
+    local_model, local_optimizer = state['model_pool'].acquire(state['weights'], lr)
+
+    # Local training with FedProx, the global weights are the proximal reference
+    local_learning(
+        local_model,
+        state['mu'],
+        local_optimizer,
+        stream,
+        state['n_SGD'],
+        loss_classifier,
+        w0=state['weights'],
+    )
+    stream.close()
+
+    flat_params = parameters_to_vector(local_model.parameters()).detach()
+    state['model_pool'].release(local_model, local_optimizer)
+    return flat_params
+
+class LocalModelPool:
+    """
+    Pre-built local model instances with their FedProxSGD optimizers, reused by the local jobs
+    instead of a deepcopy of the global model and a new optimizer per client.
+    acquire() resets an instance in place from a flat weight vector with copy_, and
+    release() hands it back; a new instance is only built when all are in use.
+    """
+
+    def __init__(self, model, size: int = 1):
+        self.template = deepcopy(model)
+        self.free = [self._build() for _ in range(size)]
+
+    def _build(self):
+        local_model = deepcopy(self.template)
+        return local_model, FedProxSGD(local_model.parameters(), lr=0.0)
+
+    def acquire(self, flat_weights, lr):
+        local_model, optimizer = self.free.pop() if self.free else self._build()
+        load_flat_params(local_model, flat_weights)
+        for group in optimizer.param_groups:
+            group['lr'] = lr
+        optimizer.zero_grad(set_to_none=True)
+        return local_model, optimizer
+
+    def release(self, local_model, optimizer):
+        self.free.append((local_model, optimizer))
+
+class ClientExecutor:
+    """
+    Runs the local updates of the sampled clients of a round.
+    With n_workers > 0 the jobs run on a pool of forked worker processes. The global
+    weights are handed over through a flat shared-memory buffer that is refreshed
+    every round and doubles as the read-only proximal reference, and each worker keeps
+    its own copy of the client datasets and of the LocalModelPool.
+    Every job is seeded from (initial torch seed, round, position in the round), and the
+    executor tracks how far each client's batch stream has gone, so the updates are
+    identical whatever the number of workers.
+    Workers run on CPU; with config.USE_GPU the jobs run in-process.
+    In-process, config.BATCHED_TRAINING trains TRAINING_CHUNK clients at a time with
+    train_clients_batched instead of one after the other.
+    """
+
+    def __init__(self, model, training_sets: list, mu, n_SGD: int, n_workers=None):
+        if n_workers is None:
+            n_workers = config.N_WORKERS
+        if config.USE_GPU and n_workers > 0:
+            print("ClientExecutor: worker processes run on CPU only, training in-process")
+            n_workers = 0
+
+        self.base_seed = torch.initial_seed()
+        self.weights = parameters_to_vector(model.parameters()).detach().clone()
+        if n_workers > 0:
+            self.weights.share_memory_()
+
+        _EXECUTOR_STATE.clear()
+        _EXECUTOR_STATE.update(
+            model=deepcopy(model),
+            training_sets=training_sets,
+            weights=self.weights,
+            mu=mu,
+            n_SGD=n_SGD,
+            base_seed=self.base_seed,
+            streams={},
+            model_pool=LocalModelPool(model),
+        )
+        self.n_SGD = n_SGD
+        self.stream_steps = np.zeros(len(training_sets), dtype=int)
+
+        self.pool = None
+        if n_workers > 0:
+            self.pool = mp.get_context("fork").Pool(n_workers, initializer=_init_worker)
+        self.batched = config.BATCHED_TRAINING and functional_call is not None
+
+    def train(self, model, clients, lr, round_idx: int, K_desired=None, hatN=None):
+        """
+        Train every client of `clients` from the weights of `model`.
+        Returns an iterator over the flat trained parameters, in the order of `clients`.
+        """
+        self.weights.copy_(parameters_to_vector(model.parameters()).detach())
+        jobs = []
+        for position, k in enumerate(clients):
+            jobs.append((int(k), _job_seed(self.base_seed, round_idx, position), lr, K_desired, hatN,
+                         int(self.stream_steps[k])))
+            if K_desired is None:
+                # a client drawn again in the round continues its stream with fresh batches
+                self.stream_steps[k] += self.n_SGD
+
+        if self.pool is not None:
+            return self.pool.imap(_train_job, jobs)
+        if self.batched:
+            return self._train_batched(jobs)
+        return (self._train_in_process(job) for job in jobs)
+
+    def _train_batched(self, jobs):
+        state = _EXECUTOR_STATE
+        load_flat_params(state['model'], self.weights)
+        for start in range(0, len(jobs), config.TRAINING_CHUNK):
+            chunk = jobs[start:start + config.TRAINING_CHUNK]
+
+            # keep the caller's random streams untouched, as for the sequential jobs
+            np_state, py_state = np.random.get_state(), random.getstate()
+            with torch.random.fork_rng():
+                streams = []
+                for job in chunk:
+                    # a client drawn twice in the chunk needs a second, independent stream
+                    repeated = any(other[0] == job[0] for other in chunk[:len(streams)])
+                    streams.append(_job_stream(job, state, persistent=not repeated))
+                active = [stream for stream in streams if stream is not None]
+                trained = []
+                if active:
+                    trained = train_clients_batched(
+                        state['model'], active, state['mu'], state['n_SGD'], chunk[0][2]
+                    )
+            np.random.set_state(np_state)
+            random.setstate(py_state)
+
+            trained = iter(trained)
+            for stream in streams:
+                if stream is None:
+                    # no data sampled, the client sends back the global model
+                    yield self.weights.clone()
+                else:
+                    stream.close()
+                    yield next(trained)
+
+    @staticmethod
+    def _train_in_process(job):
+        # keep the caller's random streams untouched, as if the job ran in a worker
+        np_state, py_state = np.random.get_state(), random.getstate()
+        with torch.random.fork_rng():
+            flat_params = _train_job(job)
+        np.random.set_state(np_state)
+        random.setstate(py_state)
+        return flat_params
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
 def FedProx_random_sampling(
     model,
     n_sampled,
@@ -135,6 +633,7 @@ def FedProx_random_sampling(
     mu,
 ):
     K = len(training_sets)  # number of clients
+    timer = RoundTimer(n_iter)
     n_samples = np.array([len(db.dataset) for db in training_sets])
     weights = n_samples / np.sum(n_samples) #(k,)
     print("Clients' weights:", weights)
@@ -142,84 +641,58 @@ def FedProx_random_sampling(
     loss_hist = np.zeros((n_iter + 1, K))
     acc_hist = np.zeros((n_iter + 1, K))
     
-    for k, dl in enumerate(training_sets):
-
-        loss_hist[0, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-        acc_hist[0, k] = accuracy_dataset(model, dl)
-        
     # LOSS AND ACCURACY OF THE INITIAL MODEL
-    server_loss = np.dot(weights, loss_hist[0])
-    server_acc = np.dot(weights, acc_hist[0])
-    print(f"====> i: 0 Loss: {server_loss} Test Accuracy: {server_acc}")
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter)
+    with timer.stage('evaluate', 0):
+        evaluator.evaluate(model, loss_hist, acc_hist, 0)
 
     sampled_clients_hist = np.zeros((n_iter, K)).astype(int)
+    executor = ClientExecutor(model, training_sets, mu, n_SGD)
+    ledger = CommLedger(model, K, n_iter)
 
     for i in range(n_iter):
 
-        clients_params = []
+        with timer.stage('sample', i + 1):
+            np.random.seed(i)
+            sampled_clients = random.sample([x for x in range(K)], n_sampled)
 
-        np.random.seed(i)
-        sampled_clients = random.sample([x for x in range(K)], n_sampled)
-
-        for k in sampled_clients:
-
-            local_model = deepcopy(model)
-            local_optimizer = optim.SGD(local_model.parameters(), lr=lr)
+        weights_ = [weights[client] for client in sampled_clients]
+        aggregator = StreamingAggregator(model, global_weight=1 - sum(weights_))
 
-            local_learning(
-                local_model,
-                mu,
-                local_optimizer,
-                training_sets[k],
-                n_SGD,
-                loss_classifier,
-            )
+        with timer.stage('train', i + 1):
+            local_updates = executor.train(model, sampled_clients, lr, i)
+            ledger.record_training(i, sampled_clients)
+            for k, weight, local_params in zip(sampled_clients, weights_, local_updates):
 
-            # GET THE PARAMETER TENSORS OF THE MODEL
-            list_params = list(local_model.parameters())
-            list_params = [tens_param.detach() for tens_param in list_params]
-            clients_params.append(list_params)
+                # ADD THE CLIENT'S CONTRIBUTION TO THE NEW GLOBAL MODEL
+                with timer.stage('aggregate', i + 1):
+                    aggregator.add(local_params, weight)
 
-            sampled_clients_hist[i, k] = 1
+                sampled_clients_hist[i, k] = 1
 
         # CREATE THE NEW GLOBAL MODEL
-        new_model = deepcopy(model)
-        weights_ = [weights[client] for client in sampled_clients]
-
-        for layer_weigths in new_model.parameters():
-            layer_weigths.data.sub_(sum(weights_) * layer_weigths.data)
-
-        for k, client_hist in enumerate(clients_params):
-            for idx, layer_weights in enumerate(new_model.parameters()):
-                contribution = client_hist[idx].data * weights_[k]
-                layer_weights.data.add_(contribution)
-
-        model = new_model
+        with timer.stage('aggregate', i + 1):
+            aggregator.write(model)
 
         # COMPUTE THE LOSS/ACCURACY OF THE DIFFERENT CLIENTS WITH THE NEW MODEL
-        for k, dl in enumerate(training_sets):
-            loss_hist[i + 1, k] = float(
-                loss_dataset(model, dl, loss_classifier).detach()
-            )
-
-        for k, dl in enumerate(testing_sets):
-            acc_hist[i + 1, k] = accuracy_dataset(model, dl)
-
-        server_loss = np.dot(weights, loss_hist[i + 1])
-        server_acc = np.dot(weights, acc_hist[i + 1])
-
-        print(
-            f"====> i: {i+1} Loss: {server_loss} Server Test Accuracy: {server_acc}"
-        )
+        with timer.stage('evaluate', i + 1):
+            evaluator.evaluate(model, loss_hist, acc_hist, i + 1)
 
         # DECREASING THE LEARNING RATE AT EACH SERVER ITERATION
         lr *= decay
 
+    executor.close()
+    ledger.summary()
+    timer.summary()
+
     # SAVE THE DIFFERENT TRAINING HISTORY
     #    save_pkl(models_hist, "local_model_history", file_name)
     #    save_pkl(server_hist, "server_history", file_name)
     save_pkl(loss_hist, "loss", file_name)
     save_pkl(acc_hist, "acc", file_name)
+    save_pkl(evaluator.history, "eval", file_name)
+    save_pkl(ledger.bytes, "comm", file_name)
+    timer.save(file_name)
 
     torch.save(
         model.state_dict(), f"saved_exp_info/final_model/{file_name}.pth"
@@ -240,6 +713,7 @@ def FedProx_importance_sampling(
     mu,
 ):
     K = len(training_sets)  # number of clients
+    timer = RoundTimer(n_iter)
     n_samples = np.array([len(db.dataset) for db in training_sets])
     weights = n_samples / np.sum(n_samples)
     print("Clients' weights:", weights)
@@ -247,85 +721,59 @@ def FedProx_importance_sampling(
     loss_hist = np.zeros((n_iter + 1, K))
     acc_hist = np.zeros((n_iter + 1, K))
 
-    for k, dl in enumerate(training_sets):
-
-        loss_hist[0, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-        acc_hist[0, k] = accuracy_dataset(model, dl)
-
     # LOSS AND ACCURACY OF THE INITIAL MODEL
-    server_loss = np.dot(weights, loss_hist[0])
-    server_acc = np.dot(weights, acc_hist[0])
-    print(f"====> i: 0 Loss: {server_loss} Test Accuracy: {server_acc}")
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter)
+    with timer.stage('evaluate', 0):
+        evaluator.evaluate(model, loss_hist, acc_hist, 0)
 
     sampled_clients_hist = np.zeros((n_iter, K)).astype(int)
+    executor = ClientExecutor(model, training_sets, mu, n_SGD)
+    ledger = CommLedger(model, K, n_iter)
 
     for i in range(n_iter):
 
-        clients_params = []
-
-        np.random.seed(i)
-        sampled_clients = np.random.choice(
-            K, size=n_sampled, replace=True, p=weights
-        )
-
-        for k in sampled_clients:
-
-            local_model = deepcopy(model)
-            local_optimizer = optim.SGD(local_model.parameters(), lr=lr)
-
-            local_learning(
-                local_model,
-                mu,
-                local_optimizer,
-                training_sets[k],
-                n_SGD,
-                loss_classifier,
+        with timer.stage('sample', i + 1):
+            np.random.seed(i)
+            sampled_clients = np.random.choice(
+                K, size=n_sampled, replace=True, p=weights
             )
 
-            # GET THE PARAMETER TENSORS OF THE MODEL
-            list_params = list(local_model.parameters())
-            list_params = [tens_param.detach() for tens_param in list_params]
-            clients_params.append(list_params)
+        aggregator = StreamingAggregator(model)
 
-            sampled_clients_hist[i, k] = 1
+        with timer.stage('train', i + 1):
+            local_updates = executor.train(model, sampled_clients, lr, i)
+            ledger.record_training(i, sampled_clients)
+            for k, local_params in zip(sampled_clients, local_updates):
 
-        # CREATE THE NEW GLOBAL MODEL
-        new_model = deepcopy(model)
-        weights_ = [1 / n_sampled] * n_sampled
-        for layer_weigths in new_model.parameters():
-            layer_weigths.data.sub_(layer_weigths.data)
+                # ADD THE CLIENT'S CONTRIBUTION TO THE NEW GLOBAL MODEL
+                with timer.stage('aggregate', i + 1):
+                    aggregator.add(local_params, 1 / n_sampled)
 
-        for k, client_hist in enumerate(clients_params):
-            for idx, layer_weights in enumerate(new_model.parameters()):
-                contribution = client_hist[idx].data * weights_[k]
-                layer_weights.data.add_(contribution)
+                sampled_clients_hist[i, k] = 1
 
-        model = new_model
+        # CREATE THE NEW GLOBAL MODEL
+        with timer.stage('aggregate', i + 1):
+            aggregator.write(model)
 
         # COMPUTE THE LOSS/ACCURACY OF THE DIFFERENT CLIENTS WITH THE NEW MODEL
-        for k, dl in enumerate(training_sets):
-            loss_hist[i + 1, k] = float(
-                loss_dataset(model, dl, loss_classifier).detach()
-            )
-
-        for k, dl in enumerate(testing_sets):
-            acc_hist[i + 1, k] = accuracy_dataset(model, dl)
-
-        server_loss = np.dot(weights, loss_hist[i + 1])
-        server_acc = np.dot(weights, acc_hist[i + 1])
-
-        print(
-            f"====> i: {i+1} Loss: {server_loss} Server Test Accuracy: {server_acc}"
-        )
+        with timer.stage('evaluate', i + 1):
+            evaluator.evaluate(model, loss_hist, acc_hist, i + 1)
 
         # DECREASING THE LEARNING RATE AT EACH SERVER ITERATION
         lr *= decay
 
+    executor.close()
+    ledger.summary()
+    timer.summary()
+
     # SAVE THE DIFFERENT TRAINING HISTORY
     #    save_pkl(models_hist, "local_model_history", file_name)
     #    save_pkl(server_hist, "server_history", file_name)
     save_pkl(loss_hist, "loss", file_name)
     save_pkl(acc_hist, "acc", file_name)
+    save_pkl(evaluator.history, "eval", file_name)
+    save_pkl(ledger.bytes, "comm", file_name)
+    timer.save(file_name)
 
     torch.save(
         model.state_dict(), f"saved_exp_info/final_model/{file_name}.pth"
@@ -351,6 +799,7 @@ def FedProx_stratified_sampling(
     Modified FedProx with stratified sampling based on gradient norms and K_desired samples
     """
     K = len(training_sets)  # number of clients
+    timer = RoundTimer(n_iter)
     n_samples = np.array([len(db.dataset) for db in training_sets])
     weights = n_samples / np.sum(n_samples)
     #print("Clients' weights:", weights)
@@ -359,138 +808,97 @@ def FedProx_stratified_sampling(
     loss_hist = np.zeros((n_iter + 1, K))
     acc_hist = np.zeros((n_iter + 1, K))
 
-    for k, dl in enumerate(training_sets):
-        loss_hist[0, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-        acc_hist[0, k] = accuracy_dataset(model, dl)
-
     # LOSS AND ACCURACY OF THE INITIAL MODEL
-    server_loss = np.dot(weights, loss_hist[0])
-    server_acc = np.dot(weights, acc_hist[0])
-    print(f"====> i: 0 Loss: {server_loss} Test Accuracy: {server_acc}")
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter)
+    with timer.stage('evaluate', 0):
+        evaluator.evaluate(model, loss_hist, acc_hist, 0)
 
     sampled_clients_hist = np.zeros((n_iter, K)).astype(int)
+    executor = ClientExecutor(model, training_sets, mu, n_SGD)
+    ledger = CommLedger(model, K, n_iter)
+    sketch_cache = GradientSketchCache(K)
+    stratifier = IncrementalStratifier(args.strata_num) if config.STRATIFY_WARM_START else None
+    selects = []
 
     for i in range(n_iter):
-        # 1. Get compressed gradients from all clients
-        compressed_grads, grad_indices = collect_compressed_gradients(model, training_sets, d_prime)
+        # 1. Get compressed gradients from all clients, re-probing only the stale ones
+        with timer.stage('probe', i + 1):
+            compressed_grads, grad_messages = sketch_cache.refresh(model, training_sets, d_prime, i, selects, ledger)
 
         # 2. Stratify clients based on compressed gradients ******************************
         # Use compressed gradients for stratification
-        stratify_result = stratify_clients_compressed_gradients(args, compressed_grads)
+        with timer.stage('stratify', i + 1):
+            stratify_result = stratify_clients_compressed_gradients(args, compressed_grads, stratifier)
 
-        N_STRATA = len(stratify_result)
         SIZE_STRATA = [len(cls) for cls in stratify_result]
-        N_CLIENTS = sum(len(c) for c in stratify_result)  # number of clients
 
         # 3. Server computes the m_h *****************************************************
         # cal_allocation_number_NS uses Neyman allocation with N_h and S_h to calculate m_h
         # Note: S_h is calculated using compressed gradients, not restored gradients
-        allocation_number = []
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA,
-                                                         args.sample_ratio)
+        with timer.stage('allocate', i + 1):
+            allocation_number = []
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA,
+                                                             args.sample_ratio)
         print(f"Allocation numbers (if any): {allocation_number}")
 
         # 4. Compute sampling probabilities based on gradient norms
-        chosen_p = np.zeros((N_STRATA, N_CLIENTS)).astype(float)
-        for j, cls in enumerate(stratify_result):
-            client_grad_norms = []
-            for k in cls:
-                grad_norm = np.linalg.norm(compressed_grads[k])
-                client_grad_norms.append(grad_norm)
-
-            # Find Summation of ||Z_t^k|| for this stratum
-            sum_norms = sum(client_grad_norms)
-            # Find p_t^k
-            for idx, k in enumerate(cls):
-                chosen_p[j][k] = round(client_grad_norms[idx] / sum_norms, 12) \
-                                 if sum_norms != 0 else 0
-        
+        # p_t^k = ||Z_t^k|| / sum of ||Z_t^j|| over the stratum of k, normalised by the sampler
+        client_grad_norms = np.linalg.norm(compressed_grads, axis=1)
+
         # Sampling clients based on stratification
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            selects = sample_clients_with_allocation(chosen_p, allocation_number)
-        else:
-            choice_num = int(100 * args.sample_ratio / args.strata_num)
-            selects = sample_clients_without_allocation(chosen_p, choice_num)
-        if args.partition == 'iid':
-            selects = choice(100, int(100 * args.sample_ratio), replace=False,
-                             p=[0.01 for _ in range(100)])
+        with timer.stage('sample', i + 1):
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                selects = sample_clients_stratified(stratify_result, client_grad_norms, allocation_number)
+            else:
+                choice_num = int(K * args.sample_ratio / args.strata_num)
+                selects = sample_clients_stratified(stratify_result, client_grad_norms, choice_num)
+            if args.partition == 'iid':
+                selects = choice(K, int(K * args.sample_ratio), replace=False)
             
         #selected = []
         #for _ in selects:
         #    selected.append(_)
         #print("Chosen clients: ", selected)
-        clients_params = []
-        clients_models = []
+        aggregator = StreamingAggregator(model)
         sampled_clients_for_grad = []
 
-        for k in selects:
-            local_model = deepcopy(model)
-            local_optimizer = optim.SGD(local_model.parameters(), lr=lr)
-
-
-            #total_samples = len(training_sets[k].dataset)
-
-            full_subset = training_sets[k].dataset
-            train_loader = torch.utils.data.DataLoader(
-                full_subset,
-                batch_size=args.batch_size,
-                shuffle=True
-            )
-
-            # Local training with FedProx
-            local_learning(
-                local_model,
-                mu,
-                local_optimizer,
-                train_loader,
-                n_SGD,
-                loss_classifier,
-            )
-
-            # Append parameters for aggregation
-            list_params = list(local_model.parameters())
-            list_params = [tens_param.detach() for tens_param in list_params]
-            clients_params.append(list_params)
-            clients_models.append(deepcopy(local_model))
-            sampled_clients_for_grad.append(k)
-            sampled_clients_hist[i, k] = 1
+        # Local training with FedProx on the full client data
+        with timer.stage('train', i + 1):
+            local_updates = executor.train(model, selects, lr, i)
+            ledger.record_training(i, selects)
+            for k, local_params in zip(selects, local_updates):
+                # Fold the client's update into the aggregate
+                with timer.stage('aggregate', i + 1):
+                    aggregator.add(local_params, 1.0 / n_sampled)
+                sampled_clients_for_grad.append(k)
+                sampled_clients_hist[i, k] = 1
 
         # Create the new global model by aggregating client updates
-        new_model = deepcopy(model)
-        for layer_weights in new_model.parameters():
-            layer_weights.data.zero_()
-        n_contrib = len(clients_params)
-        if n_contrib > 0:
-            weights_ = [1.0 / n_sampled] * n_contrib
-
-            # Add the contributions
-            for k, client_hist in enumerate(clients_params):
-                for idx, layer_weights in enumerate(new_model.parameters()):
-                    layer_weights.data.add_(client_hist[idx].data * weights_[k])
-
-            model = new_model
-        else:
-            # If no clients contributed (edge case), model stays the same
-            pass
+        with timer.stage('aggregate', i + 1):
+            if aggregator.n_contrib > 0:
+                aggregator.write(model)
+            else:
+                # If no clients contributed (edge case), model stays the same
+                pass
 
         # Compute the loss/accuracy of the different clients with the new model
-        for k, dl in enumerate(training_sets):
-            loss_hist[i + 1, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-
-        for k, dl in enumerate(testing_sets):
-            acc_hist[i + 1, k] = accuracy_dataset(model, dl)
-
-        server_loss = np.dot(weights, loss_hist[i + 1])
-        server_acc = np.dot(weights, acc_hist[i + 1])
-
-        print(f"====> i: {i + 1} Loss: {server_loss} Server Test Accuracy: {server_acc}")
+        with timer.stage('evaluate', i + 1):
+            evaluator.evaluate(model, loss_hist, acc_hist, i + 1, stratify_result)
 
         lr *= decay
 
+    executor.close()
+    ledger.summary()
+    timer.summary()
+
     # Save the training history
     save_pkl(loss_hist, "loss", file_name)
     save_pkl(acc_hist, "acc", file_name)
+    save_pkl(evaluator.history, "eval", file_name)
+    save_pkl(ledger.bytes, "comm", file_name)
+    timer.save(file_name)
+    save_pkl(sketch_cache.history, "probe", file_name)
 
     torch.save(
         model.state_dict(), f"saved_exp_info/final_model/{file_name}.pth"
@@ -520,145 +928,110 @@ def FedProx_stratified_dp_sampling(
     estimator = Estimator(train_users, alpha, M)
 
     K = len(training_sets)  # number of clients
+    timer = RoundTimer(n_iter)
     n_samples = np.array([len(db.dataset) for db in training_sets])
     weights = n_samples / np.sum(n_samples)
     print("Clients' weights:", weights)
 
     # 1. each client sends compressed gradients **************************************
     # Get compressed gradients from all clients
-    compressed_grads, grad_indices = collect_compressed_gradients(model, training_sets, d_prime)
+    with timer.stage('probe', 0):
+        compressed_grads, grad_messages = collect_compressed_gradients(model, training_sets, d_prime)
+        print(f"Probe upload: {sum(message.nbytes for message in grad_messages)} bytes")
 
     # 2. Stratify clients based on compressed gradients ******************************
     # Use compressed gradients for stratification
-    stratify_result = stratify_clients_compressed_gradients(args, compressed_grads)
+    with timer.stage('stratify', 0):
+        stratify_result = stratify_clients_compressed_gradients(args, compressed_grads)
 
-    N_STRATA = len(stratify_result)
     SIZE_STRATA = [len(cls) for cls in stratify_result]
-    N_CLIENTS = sum(len(c) for c in stratify_result)  # number of clients
 
     # 3. Server computes the m_h *****************************************************
     # cal_allocation_number_NS uses Neyman allocation with N_h and S_h to calculate m_h
     # Note: S_h is calculated using compressed gradients, not restored gradients
-    allocation_number = []
-    if config.WITH_ALLOCATION and not args.partition == 'shard':
-        allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA, args.sample_ratio)
+    with timer.stage('allocate', 0):
+        allocation_number = []
+        if config.WITH_ALLOCATION and not args.partition == 'shard':
+            allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA, args.sample_ratio)
     print(allocation_number)
 
     loss_hist = np.zeros((n_iter + 1, K))
     acc_hist = np.zeros((n_iter + 1, K))
 
-    for k, dl in enumerate(training_sets):
-        loss_hist[0, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-        acc_hist[0, k] = accuracy_dataset(model, dl)
-
     # LOSS AND ACCURACY OF THE INITIAL MODEL
-    server_loss = np.dot(weights, loss_hist[0])
-    server_acc = np.dot(weights, acc_hist[0])
-    print(f"====> i: 0 Loss: {server_loss} Test Accuracy: {server_acc}")
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter)
+    with timer.stage('evaluate', 0):
+        evaluator.evaluate(model, loss_hist, acc_hist, 0)
 
     sampled_clients_hist = np.zeros((n_iter, K)).astype(int)
+    executor = ClientExecutor(model, training_sets, mu, n_SGD)
+    ledger = CommLedger(model, K, n_iter)
+    # the one-off probe before training is charged to the first round
+    ledger.broadcast(0, np.arange(K))
+    ledger.record('probe', 0, np.arange(K), [message.nbytes for message in grad_messages])
+    # privacy-preserving estimates of the total population size, one per round
+    hatN_rounds = estimator.estimate_rounds(n_iter)
 
     for i in range(n_iter):
-        clients_params = []
-        clients_models = []
         sampled_clients_for_grad = []
 
         # Estimate the total population size with privacy preservation
-        hatN = estimator.estimate()
+        hatN = hatN_rounds[i]
         print(f"Estimated population size (hatN): {hatN}")
+        ledger.record('dp_response', i, np.arange(K), estimator.response_bytes)
 
         # Sampling clients based on stratification and privacy-preserving estimates
-        chosen_p = np.zeros((N_STRATA, N_CLIENTS)).astype(float)
-        for j, cls in enumerate(stratify_result):
-            for k in range(N_CLIENTS):
-                if k in cls:
-                    chosen_p[j][k] = round(1 / SIZE_STRATA[j], 12)
-        
-
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            selects = sample_clients_with_allocation(chosen_p, allocation_number)
-        else:
-            choice_num = int(100 * args.sample_ratio / args.strata_num)
-            selects = sample_clients_without_allocation(chosen_p, choice_num)
-        if args.partition == 'iid':
-            selects = choice(100, int(100 * args.sample_ratio), replace=False,
-                             p=[0.01 for _ in range(100)])
+        # uniformly within every stratum
+        with timer.stage('sample', i + 1):
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                selects = sample_clients_stratified(stratify_result, np.ones(K), allocation_number)
+            else:
+                choice_num = int(K * args.sample_ratio / args.strata_num)
+                selects = sample_clients_stratified(stratify_result, np.ones(K), choice_num)
+            if args.partition == 'iid':
+                selects = choice(K, int(K * args.sample_ratio), replace=False)
             
         selected = []
         for _ in selects:
             selected.append(_)
         print("Chosen clients: ", selected)
 
-        for k in selected:
-            local_model = deepcopy(model)
-            local_optimizer = optim.SGD(local_model.parameters(), lr=lr)
-
-            # local data sampling
-            sampled_features, sampled_labels = local_data_sampling(
-                training_sets[k], 
-                K_desired, 
-                hatN
-            )
-
-            if sampled_features is not None and len(sampled_features) > 0:
-               
-                sampled_dataset = torch.utils.data.TensorDataset(sampled_features, sampled_labels)
-                sampled_loader = torch.utils.data.DataLoader(
-                    sampled_dataset,
-                    batch_size=args.batch_size,
-                    shuffle=True
-                )
-            # Local training with FedProx
-            local_learning(
-                local_model,
-                mu,
-                local_optimizer,
-                sampled_loader,
-                n_SGD,
-                loss_classifier,
-            )
-
-            # Append parameters for aggregation
-            list_params = list(local_model.parameters())
-            list_params = [tens_param.detach() for tens_param in list_params]
-            clients_params.append(list_params)
-            clients_models.append(deepcopy(local_model))
-            sampled_clients_for_grad.append(k)
-            sampled_clients_hist[i, k] = 1
-
-        # Create the new global model by aggregating client updates
-        new_model = deepcopy(model)
         # Data-size proportional weights
         #weights_ = [weights[client] for client in selected]
         weights_ = [1/n_sampled]*n_sampled
+        aggregator = StreamingAggregator(model, global_weight=1 - sum(weights_))
+
+        # Local data sampling and local training with FedProx
+        with timer.stage('train', i + 1):
+            local_updates = executor.train(model, selected, lr, i, K_desired, hatN)
+            ledger.record_training(i, selected)
+            for k, weight, local_params in zip(selected, weights_, local_updates):
+                # Fold the client's update into the aggregate
+                with timer.stage('aggregate', i + 1):
+                    aggregator.add(local_params, weight)
+                sampled_clients_for_grad.append(k)
+                sampled_clients_hist[i, k] = 1
 
-        for layer_weights in new_model.parameters():
-            layer_weights.data.sub_(sum(weights_) * layer_weights.data)
-
-        for k, client_hist in enumerate(clients_params):
-            for idx, layer_weights in enumerate(new_model.parameters()):
-                contribution = client_hist[idx].data * weights_[k]
-                layer_weights.data.add_(contribution)
-
-        model = new_model
+        # Create the new global model by aggregating client updates
+        with timer.stage('aggregate', i + 1):
+            aggregator.write(model)
 
         # Compute the loss/accuracy of the different clients with the new model
-        for k, dl in enumerate(training_sets):
-            loss_hist[i + 1, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-
-        for k, dl in enumerate(testing_sets):
-            acc_hist[i + 1, k] = accuracy_dataset(model, dl)
-
-        server_loss = np.dot(weights, loss_hist[i + 1])
-        server_acc = np.dot(weights, acc_hist[i + 1])
-
-        print(f"====> i: {i + 1} Loss: {server_loss} Server Test Accuracy: {server_acc}")
+        with timer.stage('evaluate', i + 1):
+            evaluator.evaluate(model, loss_hist, acc_hist, i + 1, stratify_result)
 
         lr *= decay
 
+    executor.close()
+    ledger.summary()
+    timer.summary()
+
     # Save the training history
     save_pkl(loss_hist, "loss", file_name)
     save_pkl(acc_hist, "acc", file_name)
+    save_pkl(evaluator.history, "eval", file_name)
+    save_pkl(ledger.bytes, "comm", file_name)
+    timer.save(file_name)
 
     torch.save(
         model.state_dict(), f"saved_exp_info/final_model/{file_name}.pth"
@@ -689,20 +1062,15 @@ def calculate_aggregation_weights(stratify_result, chosen_p, selected_clients, n
         N_h = [len(cls) for cls in stratify_result]  # Size of each stratum
         N = n_sampled  # Total number of clients
         
-        # Count selected clients in each stratum
-        m_h = [0] * len(stratify_result)
-        for k in selected_clients:
-            for h, cls in enumerate(stratify_result):
-                if k in cls:
-                    m_h[h] += 1
-                    break
-        
         # Create mapping of client to stratum
         client_to_stratum = {}
         for h, cls in enumerate(stratify_result):
             for k in cls:
                 client_to_stratum[k] = h
-        
+
+        # Count selected clients in each stratum
+        m_h = np.bincount([client_to_stratum[k] for k in selected_clients],
+                          minlength=len(stratify_result))
         
         # Calculate weights with stability measures
         weights_ = []
@@ -772,6 +1140,7 @@ def FedProx_stratified_sampling_compressed_gradients(
     #print(f"Number of sampled clients (n_sampled): {n_sampled}")
 
     K = len(training_sets)  # number of clients
+    timer = RoundTimer(n_iter)
     n_samples = np.array([len(db.dataset) for db in training_sets])
     weights = n_samples / np.sum(n_samples)
     #print("Clients' weights:", weights)
@@ -779,177 +1148,115 @@ def FedProx_stratified_sampling_compressed_gradients(
     loss_hist = np.zeros((n_iter + 1, K))
     acc_hist = np.zeros((n_iter + 1, K))
 
-    for k, dl in enumerate(training_sets):
-        loss_hist[0, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-        acc_hist[0, k] = accuracy_dataset(model, dl)
-
     # LOSS AND ACCURACY OF THE INITIAL MODEL
-    server_loss = np.dot(weights, loss_hist[0])
-    server_acc = np.dot(weights, acc_hist[0])
-    print(f"====> i: 0 Loss: {server_loss} Test Accuracy: {server_acc}")
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter)
+    with timer.stage('evaluate', 0):
+        evaluator.evaluate(model, loss_hist, acc_hist, 0)
 
     sampled_clients_hist = np.zeros((n_iter, K)).astype(int)
+    executor = ClientExecutor(model, training_sets, mu, n_SGD)
+    ledger = CommLedger(model, K, n_iter)
+    sketch_cache = GradientSketchCache(K)
+    stratifier = IncrementalStratifier(args.strata_num) if config.STRATIFY_WARM_START else None
+    selects = []
 
     for i in range(n_iter):
-        # 1. Get compressed gradients from all clients
-        compressed_grads, grad_indices = collect_compressed_gradients(model, training_sets, d_prime)
+        # 1. Get compressed gradients from all clients, re-probing only the stale ones
+        with timer.stage('probe', i + 1):
+            compressed_grads, grad_messages = sketch_cache.refresh(model, training_sets, d_prime, i, selects, ledger)
 
         # 2. Stratify clients based on compressed gradients ******************************
         # Use compressed gradients for stratification
-        stratify_result = stratify_clients_compressed_gradients(args, compressed_grads)
+        with timer.stage('stratify', i + 1):
+            stratify_result = stratify_clients_compressed_gradients(args, compressed_grads, stratifier)
 
-        N_STRATA = len(stratify_result)
         SIZE_STRATA = [len(cls) for cls in stratify_result]
-        N_CLIENTS = sum(len(c) for c in stratify_result)  # number of clients
 
         # 3. Server computes the m_h *****************************************************
         # cal_allocation_number_NS uses Neyman allocation with N_h and S_h to calculate m_h
         # Note: S_h is calculated using compressed gradients, not restored gradients
-        allocation_number = []
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA,
-                                                         args.sample_ratio)
+        with timer.stage('allocate', i + 1):
+            allocation_number = []
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA,
+                                                             args.sample_ratio)
         print(f"Allocation numbers (if any): {allocation_number}")
 
         # 4. Compute sampling probabilities based on gradient norms
-        chosen_p = np.zeros((N_STRATA, N_CLIENTS)).astype(float)
-        for j, cls in enumerate(stratify_result):
-            client_grad_norms = []
-            for k in cls:
-                grad_norm = np.linalg.norm(compressed_grads[k])
-                client_grad_norms.append(grad_norm)
-
-            # Find Summation of ||Z_t^k|| for this stratum
-            sum_norms = sum(client_grad_norms)
-            # Find p_t^k
-            for idx, k in enumerate(cls):
-                chosen_p[j][k] = round(client_grad_norms[idx] / sum_norms, 12) \
-                                 if sum_norms != 0 else 0
-        
+        # p_t^k = ||Z_t^k|| / sum of ||Z_t^j|| over the stratum of k, normalised by the sampler
+        client_grad_norms = np.linalg.norm(compressed_grads, axis=1)
+
         # Sampling clients based on stratification
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            selects = sample_clients_with_allocation(chosen_p, allocation_number)
-        else:
-            choice_num = int(100 * args.sample_ratio / args.strata_num)
-            selects = sample_clients_without_allocation(chosen_p, choice_num)
-        if args.partition == 'iid':
-            selects = choice(100, int(100 * args.sample_ratio), replace=False,
-                             p=[0.01 for _ in range(100)])
+        with timer.stage('sample', i + 1):
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                selects = sample_clients_stratified(stratify_result, client_grad_norms, allocation_number)
+            else:
+                choice_num = int(K * args.sample_ratio / args.strata_num)
+                selects = sample_clients_stratified(stratify_result, client_grad_norms, choice_num)
+            if args.partition == 'iid':
+                selects = choice(K, int(K * args.sample_ratio), replace=False)
             
         #selected = []
         #for _ in selects:
         #    selected.append(_)
         #print("Chosen clients: ", selected)
-        clients_params = []
-        clients_models = []
         sampled_clients_for_grad = []
-        for k in selects:
-            local_model = deepcopy(model)
-            local_optimizer = optim.SGD(local_model.parameters(), lr=lr)
-            
-            # Calculate sampling probability based on actual dataset size
-            #total_samples = len(training_sets[k].dataset)
-            # Ensure sampling probability is valid (between 0 and 1)
-            #sampling_prob = K_desired #prop = 0.5
-            #print(f"Client {k} - Total samples: {total_samples}, K_desired: {K_desired}, Sampling prob: {sampling_prob}")
-            
-            # Sample data points
-            sampled_features = []
-            sampled_labels = []
-            
-            for features, labels in training_sets[k]:
-                sample_mask = np.random.binomial(n=1, p=K_desired, size=len(features))
-                selected_features = features[sample_mask == 1]
-                selected_labels = labels[sample_mask == 1]
-                
-                if len(selected_features) > 0:
-                    sampled_features.append(selected_features)
-                    sampled_labels.append(selected_labels)
-
-            if sampled_features:
-                sampled_features = torch.cat(sampled_features)
-                sampled_labels = torch.cat(sampled_labels)
-                if sampled_features is not None and len(sampled_features) > 0:
-                    sampled_dataset = torch.utils.data.TensorDataset(sampled_features, sampled_labels)
-                    sampled_loader = torch.utils.data.DataLoader(
-                        sampled_dataset,
-                        batch_size=args.batch_size,
-                        shuffle=True
-                    )
 
-                # Local training with FedProx
-                local_learning(
-                    local_model,
-                    mu,
-                    local_optimizer,
-                    sampled_loader,
-                    n_SGD,
-                    loss_classifier,
+        # The aggregation weights only depend on the selected clients, so they are known
+        # before training and every update is folded in as soon as it arrives
+        with timer.stage('aggregate', i + 1):
+            if config.AGGREGATION_WEIGHTS == 'proposed':
+                # Calculate weights using the new function with stability measures
+                weights_ = calculate_aggregation_weights(
+                    stratify_result, 
+                    client_grad_norms, 
+                    selects,
+                    n_sampled=n_sampled, 
+                    weighting_scheme='proposed',
+                    training_sets=training_sets
                 )
-
-            # Append parameters for aggregation
-            list_params = list(local_model.parameters())
-            list_params = [tens_param.detach() for tens_param in list_params]
-            clients_params.append(list_params)
-            clients_models.append(deepcopy(local_model))
-            sampled_clients_for_grad.append(k)
-            sampled_clients_hist[i, k] = 1
-
-        #if not clients_params:  # Skip aggregation if no clients had samples
-        #    print("Warning: No clients had valid samples in this round")
-        #    continue
-
-        # Create the new global model by aggregating client updates
-        new_model = deepcopy(model)
-        
-        # Calculate weights using the new function with stability measures
-        '''
-        weights_ = calculate_aggregation_weights(
-            stratify_result, 
-            chosen_p, 
-            sampled_clients_for_grad,
-            n_sampled=n_sampled, 
-            weighting_scheme='proposed',
-            training_sets=training_sets
-        )
-        '''
-
+            else:
+                weights_ = [1.0 / n_sampled] * len(selects)
         #print(f"Round {i+1} - Sum of weights: {sum(weights_):.6f} (should be close to {1.0/n_sampled:.6f})")
+        aggregator = StreamingAggregator(model)
+
+        # Each client keeps every data point with probability K_desired (prop = 0.5)
+        # and runs local training with FedProx on the sampled data
+        with timer.stage('train', i + 1):
+            local_updates = executor.train(model, selects, lr, i, K_desired, 1)
+            ledger.record_training(i, selects)
+            for k, weight, local_params in zip(selects, weights_, local_updates):
+                # Fold the client's update into the aggregate
+                with timer.stage('aggregate', i + 1):
+                    aggregator.add(local_params, weight)
+                sampled_clients_for_grad.append(k)
+                sampled_clients_hist[i, k] = 1
 
-        # Aggregate model updates
-        for layer_weights in new_model.parameters():
-            layer_weights.data.zero_()
-        n_contrib = len(clients_params)
-        if n_contrib > 0:
-            weights_ = [1.0 / n_sampled] * n_contrib
-
-            # Add the contributions
-            for k, client_hist in enumerate(clients_params):
-                for idx, layer_weights in enumerate(new_model.parameters()):
-                    layer_weights.data.add_(client_hist[idx].data * weights_[k])
-
-            model = new_model
-        else:
-            # If no clients contributed (edge case), model stays the same
-            pass
+        # Create the new global model by aggregating client updates
+        with timer.stage('aggregate', i + 1):
+            if aggregator.n_contrib > 0:
+                aggregator.write(model)
+            else:
+                # If no clients contributed (edge case), model stays the same
+                pass
 
         # Compute the loss/accuracy of the different clients with the new model
-        for k, dl in enumerate(training_sets):
-            loss_hist[i + 1, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-
-        for k, dl in enumerate(testing_sets):
-            acc_hist[i + 1, k] = accuracy_dataset(model, dl)
-
-        server_loss = np.dot(weights, loss_hist[i + 1])
-        server_acc = np.dot(weights, acc_hist[i + 1])
-
-        print(f"====> i: {i + 1} Loss: {server_loss} Server Test Accuracy: {server_acc}")
+        with timer.stage('evaluate', i + 1):
+            evaluator.evaluate(model, loss_hist, acc_hist, i + 1, stratify_result)
 
         lr *= decay
 
+    executor.close()
+    ledger.summary()
+    timer.summary()
+
     # Save the training history
     save_pkl(loss_hist, "loss", file_name)
     save_pkl(acc_hist, "acc", file_name)
+    save_pkl(evaluator.history, "eval", file_name)
+    save_pkl(ledger.bytes, "comm", file_name)
+    timer.save(file_name)
+    save_pkl(sketch_cache.history, "probe", file_name)
 
     torch.save(
         model.state_dict(), f"saved_exp_info/final_model/{file_name}.pth"
@@ -980,6 +1287,7 @@ def FedProx_stratified_dp_sampling_compressed_gradients(
     estimator = Estimator(train_users, alpha, M)
 
     K = len(training_sets)  # number of clients
+    timer = RoundTimer(n_iter)
     n_samples = np.array([len(db.dataset) for db in training_sets])
     #num_data = sum(len(dl.dataset) for dl in training_sets)
     # K_desired is now derived from the total data * fraction
@@ -995,151 +1303,107 @@ def FedProx_stratified_dp_sampling_compressed_gradients(
     loss_hist = np.zeros((n_iter + 1, K))
     acc_hist = np.zeros((n_iter + 1, K))
 
-    for k, dl in enumerate(training_sets):
-        loss_hist[0, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-        acc_hist[0, k] = accuracy_dataset(model, dl)
-
     # LOSS AND ACCURACY OF THE INITIAL MODEL
-    server_loss = np.dot(weights, loss_hist[0])
-    server_acc = np.dot(weights, acc_hist[0])
-    print(f"====> i: 0 Loss: {server_loss} Test Accuracy: {server_acc}")
+    evaluator = ClientEvaluator(training_sets, testing_sets, weights, n_iter)
+    with timer.stage('evaluate', 0):
+        evaluator.evaluate(model, loss_hist, acc_hist, 0)
 
     sampled_clients_hist = np.zeros((n_iter, K)).astype(int)
+    executor = ClientExecutor(model, training_sets, mu, n_SGD)
+    ledger = CommLedger(model, K, n_iter)
+    # privacy-preserving estimates of the total population size, one per round
+    hatN_rounds = estimator.estimate_rounds(n_iter)
+    sketch_cache = GradientSketchCache(K)
+    stratifier = IncrementalStratifier(args.strata_num) if config.STRATIFY_WARM_START else None
+    selects = []
 
     for i in range(n_iter):
-        # 1. Get compressed gradients from all clients
-        compressed_grads, grad_indices = collect_compressed_gradients(model, training_sets, d_prime)
+        # 1. Get compressed gradients from all clients, re-probing only the stale ones
+        with timer.stage('probe', i + 1):
+            compressed_grads, grad_messages = sketch_cache.refresh(model, training_sets, d_prime, i, selects, ledger)
 
         # 2. Stratify clients based on compressed gradients ******************************
         # Use compressed gradients for stratification
-        stratify_result = stratify_clients_compressed_gradients(args, compressed_grads)
+        with timer.stage('stratify', i + 1):
+            stratify_result = stratify_clients_compressed_gradients(args, compressed_grads, stratifier)
 
-        N_STRATA = len(stratify_result)
         SIZE_STRATA = [len(cls) for cls in stratify_result]
-        N_CLIENTS = sum(len(c) for c in stratify_result)  # number of clients
 
         # 3. Server computes the m_h *****************************************************
         # cal_allocation_number_NS uses Neyman allocation with N_h and S_h to calculate m_h
         # Note: S_h is calculated using compressed gradients, not restored gradients
-        allocation_number = []
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA,
-                                                         args.sample_ratio)
+        with timer.stage('allocate', i + 1):
+            allocation_number = []
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                allocation_number = cal_allocation_number_NS(stratify_result, compressed_grads, SIZE_STRATA,
+                                                             args.sample_ratio)
         print(f"Allocation numbers (if any): {allocation_number}")
 
         # Estimate the total population size with privacy preservation
-        hatN = estimator.estimate()
+        hatN = hatN_rounds[i]
         print(f"Estimated population size (hatN): {hatN}")
+        ledger.record('dp_response', i, np.arange(K), estimator.response_bytes)
 
         # 4. Server computes p_t^k ***************************************************
         # Note: ||Z_t^k|| is calculated using compressed gradients, not restored gradients
-        chosen_p = np.zeros((N_STRATA, N_CLIENTS)).astype(float)
-        for j, cls in enumerate(stratify_result):
-            client_grad_norms = []
-            for k in cls:
-                    # Find ||Z_t^k|| of this client and store it in an array
-                    grad_norm = np.linalg.norm(compressed_grads[k])
-                    client_grad_norms.append(grad_norm)
-
-            # Find Summation of ||Z_t^k|| for this stratum
-            sum_norms = sum(client_grad_norms)
-            # Find p_t^k
-            for idx, k in enumerate(cls):
-                chosen_p[j][k] = round(client_grad_norms[idx] / sum_norms, 12) \
-                                 if sum_norms != 0 else 0
-        
+        # p_t^k = ||Z_t^k|| / sum of ||Z_t^j|| over the stratum of k, normalised by the sampler
+        client_grad_norms = np.linalg.norm(compressed_grads, axis=1)
+
         # Sampling clients based on stratification and privacy-preserving estimates
-        if config.WITH_ALLOCATION and not args.partition == 'shard':
-            selects = sample_clients_with_allocation(chosen_p, allocation_number)
-        else:
-            choice_num = int(100 * args.sample_ratio / args.strata_num)
-            selects = sample_clients_without_allocation(chosen_p, choice_num)
-        if args.partition == 'iid':
-            selects = choice(100, int(100 * args.sample_ratio), replace=False,
-                             p=[0.01 for _ in range(100)])
+        with timer.stage('sample', i + 1):
+            if config.WITH_ALLOCATION and not args.partition == 'shard':
+                selects = sample_clients_stratified(stratify_result, client_grad_norms, allocation_number)
+            else:
+                choice_num = int(K * args.sample_ratio / args.strata_num)
+                selects = sample_clients_stratified(stratify_result, client_grad_norms, choice_num)
+            if args.partition == 'iid':
+                selects = choice(K, int(K * args.sample_ratio), replace=False)
             
         #selected = []
         #for _ in selects:
         #    selected.append(_)
         #print("Chosen clients: ", selected)
-        clients_params = []
-        clients_models = []
+        aggregator = StreamingAggregator(model)
         sampled_clients_for_grad = []
-        for k in selects:
-            local_model = deepcopy(model)
-            local_optimizer = optim.SGD(local_model.parameters(), lr=lr)
-
-            # local data sampling
-            sampled_features, sampled_labels = local_data_sampling(
-                training_sets[k], 
-                K_desired_num,
-                hatN
-            )
-
-            if sampled_features is not None and len(sampled_features) > 0:
-               
-                sampled_dataset = torch.utils.data.TensorDataset(sampled_features, sampled_labels)
-                sampled_loader = torch.utils.data.DataLoader(
-                    sampled_dataset,
-                    batch_size=args.batch_size,
-                    shuffle=True
-                )
-            # Local training with FedProx
-            local_learning(
-                local_model,
-                mu,
-                local_optimizer,
-                sampled_loader,
-                n_SGD,
-                loss_classifier,
-            )
 
-            # Append parameters for aggregation
-            list_params = list(local_model.parameters())
-            list_params = [tens_param.detach() for tens_param in list_params]
-            clients_params.append(list_params)
-            clients_models.append(deepcopy(local_model))
-            sampled_clients_for_grad.append(k)
-            sampled_clients_hist[i, k] = 1
+        # Local data sampling and local training with FedProx
+        with timer.stage('train', i + 1):
+            local_updates = executor.train(model, selects, lr, i, K_desired_num, hatN)
+            ledger.record_training(i, selects)
+            for k, local_params in zip(selects, local_updates):
+                # Fold the client's update into the aggregate
+                with timer.stage('aggregate', i + 1):
+                    aggregator.add(local_params, 1.0 / n_sampled)
+                sampled_clients_for_grad.append(k)
+                sampled_clients_hist[i, k] = 1
 
         # Create the new global model by aggregating client updates
-        new_model = deepcopy(model)
-        # Aggregate model updates
-        for layer_weights in new_model.parameters():
-            layer_weights.data.zero_()
-        n_contrib = len(clients_params)
-        if n_contrib > 0:
-            weights_ = [1.0 / n_sampled] * n_contrib
-
-            # Add the contributions
-            for k, client_hist in enumerate(clients_params):
-                for idx, layer_weights in enumerate(new_model.parameters()):
-                    layer_weights.data.add_(client_hist[idx].data * weights_[k])
-
-            model = new_model
-        else:
-            # If no clients contributed (edge case), model stays the same
-            pass
+        with timer.stage('aggregate', i + 1):
+            if aggregator.n_contrib > 0:
+                aggregator.write(model)
+            else:
+                # If no clients contributed (edge case), model stays the same
+                pass
 
 
         # Compute the loss/accuracy of the different clients with the new model
-        for k, dl in enumerate(training_sets):
-            loss_hist[i + 1, k] = float(loss_dataset(model, dl, loss_classifier).detach())
-
-        for k, dl in enumerate(testing_sets):
-            acc_hist[i + 1, k] = accuracy_dataset(model, dl)
-
-        server_loss = np.dot(weights, loss_hist[i + 1])
-        server_acc = np.dot(weights, acc_hist[i + 1])
-
-        print(f"====> i: {i + 1} Loss: {server_loss} Server Test Accuracy: {server_acc}")
+        with timer.stage('evaluate', i + 1):
+            evaluator.evaluate(model, loss_hist, acc_hist, i + 1, stratify_result)
 
         # Decrease the learning rate
         lr *= decay
 
+    executor.close()
+    ledger.summary()
+    timer.summary()
+
     # Save the training history
     save_pkl(loss_hist, "loss", file_name)
     save_pkl(acc_hist, "acc", file_name)
+    save_pkl(evaluator.history, "eval", file_name)
+    save_pkl(ledger.bytes, "comm", file_name)
+    timer.save(file_name)
+    save_pkl(sketch_cache.history, "probe", file_name)
 
     torch.save(
         model.state_dict(), f"saved_exp_info/final_model/{file_name}.pth"
@@ -43,6 +43,9 @@ print(file_name)
 """GET THE DATASETS USED FOR THE FL TRAINING"""
 from dataset.CIFAR10_partition import get_CIFAR10_dataloaders
 list_dls_train, list_dls_test = get_CIFAR10_dataloaders(args.dataset, args.partition, args.batch_size)
+if config.CLIENT_STORE:
+    list_dls_train = build_client_store(list_dls_train)
+    list_dls_test = build_client_store(list_dls_test)
 
 get_num_cnt(args, list_dls_train)
 
@@ -60,47 +63,10 @@ print("number of sampled clients", n_sampled)
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from models import CNN_CIFAR10_dropout
 
 torch.manual_seed(args.seed)
 
-class CNN_CIFAR10_dropout(torch.nn.Module):
-    """Model Used by the paper introducing FedAvg"""
-
-    def __init__(self):
-        super(CNN_CIFAR10_dropout, self).__init__()
-        self.conv1 = nn.Conv2d(
-            in_channels=3, out_channels=32, kernel_size=(3, 3)
-        )
-        self.conv2 = nn.Conv2d(
-            in_channels=32, out_channels=64, kernel_size=(3, 3)
-        )
-        self.conv3 = nn.Conv2d(
-            in_channels=64, out_channels=64, kernel_size=(3, 3)
-        )
-
-        self.fc1 = nn.Linear(4 * 4 * 64, 64)
-        self.fc2 = nn.Linear(64, 10)
-
-        self.dropout = nn.Dropout(p=0.2)
-
-    def forward(self, x):
-        x = F.relu(self.conv1(x))
-        x = F.max_pool2d(x, 2, 2)
-        x = self.dropout(x)
-
-        x = F.relu(self.conv2(x))
-        x = F.max_pool2d(x, 2, 2)
-        x = self.dropout(x)
-
-        x = self.conv3(x)
-        x = self.dropout(x)
-        x = x.view(-1, 4 * 4 * 64)
-
-        x = F.relu(self.fc1(x))
-
-        x = self.fc2(x)
-        return x
-
 model_cifar10 = CNN_CIFAR10_dropout()
 if config.USE_GPU:
     model_cifar10 = model_cifar10.cuda()
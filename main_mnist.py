@@ -42,6 +42,9 @@ print(file_name)
 """GET THE DATASETS USED FOR THE FL TRAINING"""
 from dataset.MNIST_partition import get_MNIST_dataloaders
 list_dls_train, list_dls_test = get_MNIST_dataloaders(args.dataset, args.partition, args.batch_size)
+if config.CLIENT_STORE:
+    list_dls_train = build_client_store(list_dls_train)
+    list_dls_test = build_client_store(list_dls_test)
 
 get_num_cnt(args, list_dls_train)
 
@@ -55,20 +58,10 @@ print("number fo sampled clients", n_sampled)
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from models import NN
 
 torch.manual_seed(args.seed)
 
-class NN(nn.Module):
-    def __init__(self, layer_1, layer_2):
-        super(NN, self).__init__()
-        self.fc1 = nn.Linear(784, layer_1)
-        self.fc2 = nn.Linear(layer_1, 10)
-
-    def forward(self, x):
-        x = F.relu(self.fc1(x.view(-1, 784)))
-        x = self.fc2(x)
-        return x
-
 model_mnist = NN(50, 10)
 if config.USE_GPU:
     model_mnist = model_mnist.cuda()
@@ -8,11 +8,42 @@ import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 
+def aggregate_clients(loss_data, acc_data, eval_history=None):
+    """
+    Average the per-client histories over the clients. Rounds that were not evaluated
+    are NaN for every client and are dropped.
+    When only some clients were evaluated (EVAL_CLIENTS 'random' or 'stratified'), a plain
+    mean over them over-represents the small strata, so the stratified estimates of the
+    run's `eval_history` (saved_exp_info/eval/) are plotted instead.
+    """
+    evaluated = ~np.all(np.isnan(acc_data), axis=1)
+    if np.any(np.isnan(acc_data[evaluated])):
+        if eval_history is not None:
+            return {
+                'rounds': list(eval_history['round']),
+                'train_loss': list(eval_history['loss']),
+                'test_acc': list(eval_history['acc'])
+            }
+        print("Sampled evaluation without its eval history, plotting the biased mean of the evaluated clients")
+    return {
+        'rounds': np.flatnonzero(evaluated).tolist(),
+        'train_loss': np.nanmean(loss_data[evaluated], axis=1).tolist(),  # Aggregate across clients
+        'test_acc': np.nanmean(acc_data[evaluated], axis=1).tolist()
+    }
+
+def cumulative_bytes(comm_data, messages):
+    """
+    Bytes of `messages` exchanged before each row of the loss/acc histories, whose row 0
+    is the initial model and row r + 1 the model after round r.
+    """
+    per_round = sum(np.asarray(comm_data[message]).sum(axis=1) for message in messages)
+    return np.concatenate(([0], np.cumsum(per_round)))
+
 def load_results(args):
     """Dynamically load and aggregate training results for accuracy and loss."""
     results = {}
 
-    if(args.plot_type == "comparison"):
+    if(args.plot_type in ("comparison", "communication")):
         methods = {
             'random': 'Random',
             'importance': 'Importance',
@@ -30,7 +61,7 @@ def load_results(args):
     
     for method_key, method_name in methods.items():
         # Patterns for accuracy and loss files
-        if(args.plot_type == "comparison"):
+        if(args.plot_type in ("comparison", "communication")):
             acc_pattern = f"saved_exp_info/acc/{args.dataset}_{args.partition}_{method_key}_p{args.sample_ratio}_lr*_b{args.batch_size}_n*_i*_s*_d*_m*_s*.pkl"
             loss_pattern = f"saved_exp_info/loss/{args.dataset}_{args.partition}_{method_key}_p{args.sample_ratio}_lr*_b{args.batch_size}_n*_i*_s*_d*_m*_s*.pkl"
         elif(args.plot_type == "fedstas_comparison"):
@@ -52,11 +83,10 @@ def load_results(args):
 
                     # Validate data format
                     if isinstance(acc_data, np.ndarray) and isinstance(loss_data, np.ndarray):
-                        results[method_name] = {
-                            'train_loss': np.mean(loss_data, axis=1).tolist(),  # Aggregate across clients
-                            'test_acc': np.mean(acc_data, axis=1).tolist()
-                        }
+                        results[method_name] = aggregate_clients(loss_data, acc_data, load_eval_history(acc_file))
                         print(f"Loaded and aggregated results for {method_name}")
+                        if args.plot_type == "communication":
+                            add_communication(results[method_name], acc_file)
                     else:
                         print(f"Invalid data format in files for {method_name}")
             except Exception as e:
@@ -66,6 +96,53 @@ def load_results(args):
     
     return results
 
+def load_eval_history(acc_file):
+    """The ClientEvaluator history saved with a run, None if there is none"""
+    eval_file = os.path.join("saved_exp_info", "eval", os.path.basename(acc_file))
+    if not os.path.exists(eval_file):
+        return None
+    with open(eval_file, 'rb') as eval_f:
+        return pickle.load(eval_f)
+
+def add_communication(data, acc_file):
+    """Attach the cumulative upload and total bytes of the evaluated rounds of a run"""
+    comm_file = os.path.join("saved_exp_info", "comm", os.path.basename(acc_file))
+    if not os.path.exists(comm_file):
+        print(f"No communication file {comm_file}")
+        return
+    with open(comm_file, 'rb') as comm_f:
+        comm_data = pickle.load(comm_f)
+    upload = cumulative_bytes(comm_data, ['probe', 'dp_response', 'update'])
+    total = upload + cumulative_bytes(comm_data, ['broadcast'])
+    data['upload_mb'] = (upload[data['rounds']] / 2**20).tolist()
+    data['total_mb'] = (total[data['rounds']] / 2**20).tolist()
+
+def plot_communication(results, partition, sample_ratio, dataset):
+    """Plot test accuracy against the cumulative uploaded and total bytes."""
+    results = {method: data for method, data in results.items() if 'total_mb' in data}
+    if not results:
+        print("No communication results to plot. Ensure valid files are present.")
+        return
+
+    plt.figure(figsize=(15, 5))
+
+    for position, (key, label) in enumerate([('upload_mb', 'Cumulative upload (MB)'),
+                                             ('total_mb', 'Cumulative upload + download (MB)')]):
+        plt.subplot(1, 2, position + 1)
+        for method, data in results.items():
+            plt.plot(data[key], data['test_acc'], '-', linewidth=2, label=method)
+        plt.title(f'Test Accuracy vs Communication ({dataset}, Partition={partition}, q={sample_ratio})')
+        plt.xlabel(label)
+        plt.ylabel('Accuracy (%)')
+        plt.grid(True)
+        plt.legend(loc='lower right')
+
+    plt.tight_layout()
+    plot_path = f'plots/{dataset}_{partition}_communication_q{sample_ratio}.png'
+    plt.savefig(plot_path, bbox_inches='tight', dpi=300)
+    print(f"Saved communication plot to {plot_path}")
+    plt.close()
+
 def plot_algorithm_comparison(results, partition, sample_ratio, dataset, skip_points):
     """Plot algorithm comparison for training loss and accuracy."""
     if not results:
@@ -79,7 +156,7 @@ def plot_algorithm_comparison(results, partition, sample_ratio, dataset, skip_po
     for method, data in results.items():
         if 'train_loss' in data and len(data['train_loss']) > 0:
             #plt.plot(data['train_loss'][::skip_points], '-', linewidth=2, label=method)
-            x_values = range(0, len(data['train_loss']), skip_points)
+            x_values = data['rounds'][::skip_points]
             y_values = data['train_loss'][::skip_points]
             plt.plot(x_values, y_values, '-', linewidth=2, label=method)
     plt.title(f'Training Loss ({dataset}, Partition={partition}, q={sample_ratio})')
@@ -93,7 +170,7 @@ def plot_algorithm_comparison(results, partition, sample_ratio, dataset, skip_po
     for method, data in results.items():
         if 'test_acc' in data and len(data['test_acc']) > 0:
             #plt.plot(data['test_acc'][::skip_points], '-', linewidth=2, label=method)
-            x_values = range(0, len(data['test_acc']), skip_points)
+            x_values = data['rounds'][::skip_points]
             y_values = data['test_acc'][::skip_points]
             plt.plot(x_values, y_values, '-', linewidth=2, label=method)
     plt.title(f'Test Accuracy ({dataset}, Partition={partition}, q={sample_ratio})')
@@ -110,7 +187,7 @@ def plot_algorithm_comparison(results, partition, sample_ratio, dataset, skip_po
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--plot_type', type=str, default='comparison', choices=['comparison', 'fedstas_comparison'])
+    parser.add_argument('--plot_type', type=str, default='comparison', choices=['comparison', 'fedstas_comparison', 'communication'])
     parser.add_argument('--partition', type=str, default='iid')
     parser.add_argument('--sample_ratio', type=float, default=0.1)
     parser.add_argument('--batch_size', type=int, default=128)
@@ -124,7 +201,10 @@ def main():
     # Load results and plot
     print(f"Generating algorithm comparison plots for dataset={args.dataset}, partition={args.partition}, q={args.sample_ratio}...")
     results = load_results(args)
-    plot_algorithm_comparison(results, args.partition, args.sample_ratio, dataset=args.dataset, skip_points=1) # Set skip_points to 1 if don't want to skip data points
+    if args.plot_type == "communication":
+        plot_communication(results, args.partition, args.sample_ratio, dataset=args.dataset)
+    else:
+        plot_algorithm_comparison(results, args.partition, args.sample_ratio, dataset=args.dataset, skip_points=1) # Set skip_points to 1 if don't want to skip data points
 
 if __name__ == "__main__":
     main()
@@ -2,16 +2,36 @@ import numpy as np
 import torch.nn as nn
 import pandas as pd
 import pickle
+import json
+import time
+import queue
+import threading
+from itertools import islice
 from math import floor
-from numpy.random import choice
 import torch
+import torch.nn.functional as F
 from collections import defaultdict
+from contextlib import contextmanager
 from sklearn import metrics
 from sklearn.decomposition import PCA
 from sklearn.cluster import KMeans, MiniBatchKMeans
+from scipy.spatial.distance import cdist
 from copy import deepcopy
 import config
 
+try:
+    from torch.func import functional_call, grad, vmap
+except ImportError:  # torch < 2.0, fall back to the per-client probe
+    functional_call = None
+
+try:
+    from torch.utils.data import default_collate
+except ImportError:  # public from torch 1.11
+    from torch.utils.data._utils.collate import default_collate
+
+# torch.inference_mode exists from torch 1.9, no_grad is the closest before
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 def get_num_cnt(args, list_dls_train):
     labels = []
     for dl in list_dls_train:
@@ -45,82 +65,731 @@ def loss_classifier(predictions, labels):
     criterion = nn.CrossEntropyLoss()
     return criterion(predictions, labels)
 
-def client_compress_gradient(client_model, train_data, d_prime):
+def _probe_converged(mean, previous_mean, tol):
+    """Whether the running gradient mean moved by at most tol relative to its norm"""
+    change = torch.norm(mean - previous_mean, dim=-1)
+    return change <= tol * torch.norm(mean, dim=-1)
+
+def client_gradient(client_model, train_data, flatten=True, tol=None, batch_counts=None):
     """
-    Compute and compress gradients for a client
+    Averaged gradient of `client_model` over all batches of `train_data`.
+    Returned flattened, or as a list of per-layer tensors when flatten=False.
+    With `tol`, stops after the first batch (from the second on) that moves the running
+    mean by at most tol relative to its norm. The number of batches used is appended
+    to `batch_counts` if given
     """
-    # Get gradient from all batches
-    accumulated_grad = None
+    # backward() accumulates into .grad, so the batch gradients are summed in place
+    client_model.zero_grad()
     batch_count = 0
-    
+    previous_mean = None
+
     for features, labels in train_data:
 
         if config.USE_GPU:
             features = features.cuda()
             labels = labels.cuda()
-            
+
         predictions = client_model(features)
         loss = loss_classifier(predictions, labels)
         loss.backward()
-        
-        # Accumulate gradients
-        if accumulated_grad is None:
-            accumulated_grad = []
-            for param in client_model.parameters():
-                if param.grad is not None:
-                    accumulated_grad.append(param.grad.data.clone())
-        else:
-            for i, param in enumerate(client_model.parameters()):
-                if param.grad is not None:
-                    accumulated_grad[i] += param.grad.data
-        
+
         batch_count += 1
-        client_model.zero_grad()
-        
-    # Average the accumulated gradients
-    for grad in accumulated_grad:
-        grad /= batch_count
-        
+
+        if tol is not None:
+            mean = torch.cat([param.grad.flatten() for param in client_model.parameters()
+                              if param.grad is not None]) / batch_count
+            if previous_mean is not None and _probe_converged(mean, previous_mean, tol):
+                break
+            previous_mean = mean
+
+    layer_grads = [param.grad.detach() / batch_count for param in client_model.parameters()
+                   if param.grad is not None]
+    client_model.zero_grad()
+    if batch_counts is not None:
+        batch_counts.append(batch_count)
+
+    if not flatten:
+        return layer_grads
     # Flatten averaged gradient
-    grad = []
-    for acc_grad in accumulated_grad:
-        grad.append(acc_grad.flatten())
-    flat_grad = torch.cat(grad) 
-    
-    # Compress using k-means
-    grad_np = flat_grad.cpu().detach().numpy()
+    return torch.cat([g.flatten() for g in layer_grads])
+
+def last_linear(model):
+    """The last nn.Linear module of `model`, its output layer (fc2 in NN and CNN_CIFAR10_dropout)"""
+    linear = [module for module in model.modules() if isinstance(module, nn.Linear)]
+    if not linear:
+        raise ValueError(f"{type(model).__name__} has no linear layer")
+    return linear[-1]
+
+@inference_mode()
+def last_layer_gradient(model, train_data, tol=None, batch_counts=None):
+    """
+    Averaged cross-entropy gradient of the output layer of `model` only, over the batches
+    of `train_data`, in closed form from a forward pass without backward: with h the
+    input of the layer (caught by a forward hook) and r = (softmax(logits) - onehot) / B
+    the softmax residual of a batch of B samples, the weight gradient is r^T h and the
+    bias gradient is the column sum of r.
+    Returns [weight gradient, bias gradient]; `tol` and `batch_counts` are as in
+    client_gradient.
+    """
+    layer = last_linear(model)
+    inputs = []
+    hook = layer.register_forward_hook(lambda module, args, output: inputs.append(args[0]))
+
+    weight_grad, bias_grad = torch.zeros_like(layer.weight), torch.zeros(layer.out_features, device=layer.weight.device)
+    batch_count = 0
+    previous_mean = None
+    try:
+        for features, labels in train_data:
+
+            if config.USE_GPU:
+                features = features.cuda()
+                labels = labels.cuda()
+
+            inputs.clear()
+            logits = model(features)
+            residual = torch.softmax(logits, dim=1)
+            residual[torch.arange(len(labels)), labels] -= 1
+            residual /= len(labels)
+
+            weight_grad += residual.T @ inputs[-1].reshape(len(labels), -1)
+            bias_grad += residual.sum(dim=0)
+            batch_count += 1
+
+            if tol is not None:
+                mean = torch.cat([weight_grad.flatten(), bias_grad]) / batch_count
+                if previous_mean is not None and _probe_converged(mean, previous_mean, tol):
+                    break
+                previous_mean = mean
+    finally:
+        hook.remove()
+
+    if batch_counts is not None:
+        batch_counts.append(batch_count)
+    batch_count = max(batch_count, 1)
+    layer_grads = [weight_grad / batch_count]
+    if layer.bias is not None:
+        layer_grads.append(bias_grad / batch_count)
+    return layer_grads
+
+def _optimal_segments(weight, total, total_sq, n_segments):
+    """
+    Exact 1-D k-means over weighted bins by dynamic programming.
+    Bin i holds weight[i] values summing to total[i] with squares summing to total_sq[i];
+    bins are contiguous and sorted, so the optimal clusters are contiguous runs of bins.
+    Returns the start bin of each of the `n_segments` runs.
+    """
+    n = len(weight)
+    cum_w = np.concatenate(([0.0], np.cumsum(weight)))
+    cum_s = np.concatenate(([0.0], np.cumsum(total)))
+    cum_ss = np.concatenate(([0.0], np.cumsum(total_sq)))
+
+    # cost[i, j]: squared error of putting bins i..j in one cluster
+    w = cum_w[None, 1:] - cum_w[:-1, None]
+    s = cum_s[None, 1:] - cum_s[:-1, None]
+    ss = cum_ss[None, 1:] - cum_ss[:-1, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cost = np.maximum(ss - s * s / w, 0)
+    cost[np.tril_indices(n, -1)] = np.inf
+
+    best = cost[0]
+    starts = []
+    for _ in range(1, n_segments):
+        # best[j] + cost[j + 1, :] for every possible start j + 1 of the last run
+        candidates = best[:-1, None] + cost[1:, :]
+        start = np.argmin(candidates, axis=0) + 1
+        best = candidates[start - 1, np.arange(n)]
+        starts.append(start)
+
+    bounds = [0]
+    end = n - 1
+    for start in reversed(starts):
+        bounds.append(start[end])
+        end = start[end] - 1
+    return np.array(sorted(bounds))
+
+def quantize_gradient(grad, d_prime, n_bins=None):
+    """
+    Deterministic 1-D quantizer used as a drop-in for the MiniBatchKMeans compression.
+    `grad` is a flat tensor or a list of per-layer tensors; in the latter case the layers
+    are streamed one at a time and the flat gradient is never built.
+    The values are histogrammed into `n_bins` equal-width bins (sum, sum of squares and
+    count per bin), the optimal d_prime-cluster split of the bins is found exactly by
+    dynamic programming, and every value is assigned to its nearest center.
+    Returns the codebook sorted in ascending order (padded by repeating the last center
+    when there are fewer distinct bins than d_prime) and the uint8/uint16 center index
+    of every entry.
+    """
+    if n_bins is None:
+        n_bins = config.QUANTIZER_BINS
+    layers = [grad] if torch.is_tensor(grad) else list(grad)
+    layers = [layer.detach().reshape(-1) for layer in layers]
+
+    low = min(layer.min().item() for layer in layers)
+    high = max(layer.max().item() for layer in layers)
+    index_dtype = np.min_scalar_type(max(d_prime - 1, 0))
+
+    if high <= low:
+        centers = np.full(d_prime, low)
+        indices = np.zeros(sum(layer.numel() for layer in layers), dtype=index_dtype)
+        return centers, indices
+
+    # Per-bin count, sum and sum of squares, accumulated layer by layer
+    scale = n_bins / (high - low)
+    weight = np.zeros(n_bins)
+    total = np.zeros(n_bins)
+    total_sq = np.zeros(n_bins)
+    for layer in layers:
+        values = layer.double()
+        bins = ((values - low) * scale).long().clamp_(0, n_bins - 1)
+        weight += torch.bincount(bins, minlength=n_bins).cpu().numpy()
+        total += torch.bincount(bins, weights=values, minlength=n_bins).cpu().numpy()
+        total_sq += torch.bincount(bins, weights=values * values, minlength=n_bins).cpu().numpy()
+
+    occupied = weight > 0
+    weight, total, total_sq = weight[occupied], total[occupied], total_sq[occupied]
+    n_centers = min(d_prime, len(weight))
+
+    bounds = _optimal_segments(weight, total, total_sq, n_centers)
+    centers = np.add.reduceat(total, bounds) / np.add.reduceat(weight, bounds)
+    centers = np.concatenate((centers, np.full(d_prime - n_centers, centers[-1])))
+
+    # Nearest-center assignment: the centers are sorted, so bucketize on the midpoints
+    midpoints = torch.as_tensor((centers[:n_centers - 1] + centers[1:n_centers]) / 2,
+                                device=layers[0].device)
+    indices = np.concatenate([
+        torch.bucketize(layer.double(), midpoints.double()).cpu().numpy().astype(index_dtype)
+        for layer in layers
+    ])
+
+    return centers, indices
+
+class GradientSketch:
+    """
+    Seeded random linear sketch of a flat gradient of any length into `dim` values, shared
+    by every client so their sketches live in the same space.
+    Coordinate space is split into blocks of `block_size` entries whose random
+    coefficients are drawn from (seed, block), so a gradient can be streamed layer by
+    layer without building the flat vector, and every process derives the same sketch.
+        'countsketch' - each coordinate is added with a random sign to one random bucket,
+                        O(P) per gradient
+        'gaussian'    - projection on a dim x P matrix of N(0, 1/dim) entries, O(dim * P)
+    The coefficients of a block are kept per device while the cache holds less than
+    `cache_bytes`, later blocks are regenerated at every call.
+    Both preserve Euclidean distances and norms in expectation.
+    """
+
+    def __init__(self, dim, backend='countsketch', seed=0, block_size=2**16, cache_bytes=2**28):
+        if backend not in ('countsketch', 'gaussian'):
+            raise ValueError(f"Unknown sketch backend: {backend}")
+        self.dim = dim
+        self.backend = backend
+        self.seed = seed
+        self.block_size = block_size
+        self.cache_bytes = cache_bytes
+        self._blocks = {}
+        self._cached_bytes = 0
+
+    def _coefficients(self, block, device):
+        key = (block, str(device))
+        if key in self._blocks:
+            return self._blocks[key]
+
+        generator = torch.Generator().manual_seed(self.seed * 1_000_003 + block)
+        if self.backend == 'countsketch':
+            buckets = torch.randint(self.dim, (self.block_size,), generator=generator)
+            signs = torch.randint(2, (self.block_size,), generator=generator) * 2.0 - 1
+            coefficients = (buckets.to(device), signs.to(device))
+        else:
+            projection = torch.randn(self.dim, self.block_size, generator=generator) * self.dim ** -0.5
+            coefficients = (projection.to(device),)
+
+        size = sum(c.numel() * c.element_size() for c in coefficients)
+        if self._cached_bytes + size <= self.cache_bytes:
+            self._blocks[key] = coefficients
+            self._cached_bytes += size
+        return coefficients
+
+    def _add_block(self, sketch, values, block, offset):
+        # values are the entries [offset, offset + len(values)) of coordinate block `block`
+        end = offset + len(values)
+        if self.backend == 'countsketch':
+            buckets, signs = self._coefficients(block, values.device)
+            sketch.index_add_(0, buckets[offset:end], signs[offset:end] * values)
+        else:
+            projection, = self._coefficients(block, values.device)
+            sketch.addmv_(projection[:, offset:end], values)
+
+    def __call__(self, grad):
+        """Sketch of `grad`, a flat tensor or a list of per-layer tensors, as a numpy array"""
+        layers = [grad] if torch.is_tensor(grad) else list(grad)
+        sketch = torch.zeros(self.dim, device=layers[0].device)
+
+        position = 0
+        for layer in layers:
+            values = layer.detach().reshape(-1).float()
+            start = 0
+            while start < len(values):
+                block, offset = divmod(position, self.block_size)
+                length = min(len(values) - start, self.block_size - offset)
+                self._add_block(sketch, values[start:start + length], block, offset)
+                start += length
+                position += length
+
+        return sketch.cpu().numpy()
+
+_SKETCHES = {}
+
+def sketch_gradient(grad, dim=None, backend=None, seed=None):
+    """
+    Sketch of a gradient with the shared GradientSketch of (config.SKETCH_BACKEND,
+    config.SKETCH_DIM, config.SKETCH_SEED)
+    """
+    key = (config.SKETCH_BACKEND if backend is None else backend,
+           config.SKETCH_DIM if dim is None else dim,
+           config.SKETCH_SEED if seed is None else seed)
+    if key not in _SKETCHES:
+        _SKETCHES[key] = GradientSketch(key[1], key[0], key[2])
+    return _SKETCHES[key](grad)
+
+def compress_gradient(grad, d_prime):
+    """
+    Compress a gradient into d_prime centers and the center index of each entry,
+    with the backend selected by config.COMPRESSION.
+    `grad` is a flat tensor or a list of per-layer tensors.
+    The 'sketch' backend returns the config.SKETCH_DIM-dimensional sketch of the gradient
+    instead of the centers, and no indices (d_prime is not used)
+    """
+    if config.COMPRESSION == 'quantizer':
+        return quantize_gradient(grad, d_prime)
+    if config.COMPRESSION == 'sketch':
+        return sketch_gradient(grad), None
+
+    if not torch.is_tensor(grad):
+        grad = torch.cat([g.flatten() for g in grad])
+    grad_np = grad.cpu().detach().numpy()
     kmeans = MiniBatchKMeans(n_clusters=d_prime, batch_size = 512 ,random_state=0)
     indices = kmeans.fit_predict(grad_np.reshape(-1, 1))
     centers = kmeans.cluster_centers_.flatten()
-    
+
     return centers, indices
 
-def collect_compressed_gradients(model, training_sets, d_prime):
+class CompressedGradient:
+    """
+    Wire format of a client's compressed gradient, as sent to the server: the codebook
+    (centers, or the sketch for the 'sketch' backend) in config.CODEBOOK_DTYPE and the
+    center index of every entry bit-packed on ceil(log2 len(codebook)) bits.
+    encode/decode are vectorized over all entries.
+    """
+
+    def __init__(self, codebook, packed, n_entries, bits):
+        self.codebook = codebook
+        self.packed = packed
+        self.n_entries = n_entries
+        self.bits = bits
+
+    @classmethod
+    def encode(cls, centers, indices, dtype=None):
+        if dtype is None:
+            dtype = config.CODEBOOK_DTYPE
+        codebook = np.asarray(centers).astype(dtype)
+        if indices is None:
+            return cls(codebook, np.zeros(0, dtype=np.uint8), 0, 0)
+
+        indices = np.asarray(indices)
+        bits = int(np.ceil(np.log2(len(codebook)))) if len(codebook) > 1 else 0
+        # bit j of every index, least significant first, packed 8 per byte
+        planes = (indices.astype(np.uint32)[:, None] >> np.arange(bits, dtype=np.uint32)) & 1
+        packed = np.packbits(planes.astype(np.uint8).reshape(-1), bitorder='little')
+        return cls(codebook, packed, len(indices), bits)
+
+    def decode_codebook(self):
+        """The codebook as float64, without unpacking the indices"""
+        return self.codebook.astype(np.float64)
+
+    def decode(self):
+        """The codebook as float64 and the unpacked indices (None without indices)"""
+        centers = self.decode_codebook()
+        if self.n_entries == 0:
+            return centers, None
+        planes = np.unpackbits(self.packed, count=self.n_entries * self.bits, bitorder='little')
+        planes = planes.reshape(self.n_entries, self.bits).astype(np.min_scalar_type(max(len(centers) - 1, 0)))
+        indices = planes @ (1 << np.arange(self.bits)).astype(planes.dtype)
+        return centers, indices
+
+    @property
+    def nbytes(self):
+        return self.codebook.nbytes + self.packed.nbytes
+
+def client_compress_gradient(client_model, train_data, d_prime):
+    """
+    Compute and compress gradients for a client
+    """
+    return compress_gradient(client_gradient(client_model, train_data, flatten=False), d_prime)
+
+def _stack_client_batches(batches):
+    """
+    Pad the current batch of every client to a common size and stack them.
+    `batches` holds one (features, labels) pair per client, or None once that client's
+    loader is exhausted. Returns features [C, B, ...], labels [C, B] and a float mask
+    [C, B] that is 1 on real samples and 0 on padding.
+    """
+    reference = next(b for b in batches if b is not None)
+    max_size = max(len(b[1]) for b in batches if b is not None)
+    features = reference[0].new_zeros((len(batches), max_size) + tuple(reference[0].shape[1:]))
+    labels = reference[1].new_zeros((len(batches), max_size))
+    mask = torch.zeros(len(batches), max_size)
+
+    for c, batch in enumerate(batches):
+        if batch is None:
+            continue
+        size = len(batch[1])
+        features[c, :size] = batch[0]
+        labels[c, :size] = batch[1]
+        mask[c, :size] = 1
+
+    if config.USE_GPU:
+        features, labels, mask = features.cuda(), labels.cuda(), mask.cuda()
+    return features, labels, mask
+
+def batched_client_gradients(model, training_sets, chunk_size=None, tol=None, batch_counts=None):
+    """
+    Averaged full-data gradient of every client, computed from one read-only copy of the
+    global weights instead of one model copy per client.
+    Clients are processed `chunk_size` at a time: at each step the next batch of every
+    client in the chunk is padded, stacked and sent through a single vmapped
+    forward/backward pass, so each client still gets the mean of its per-batch gradients,
+    exactly like client_gradient. With `tol` a client stops being fed batches once its
+    running mean has converged, as in client_gradient.
+    Returns a list with one flat gradient per client, in the order of `training_sets`,
+    and appends the number of batches used per client to `batch_counts` if given.
+    """
+    if chunk_size is None:
+        chunk_size = config.PROBE_CHUNK
+
+    params = {name: param.detach() for name, param in model.named_parameters()}
+    buffers = {name: buf.detach() for name, buf in model.named_buffers()}
+
+    def batch_loss(params, features, labels, mask):
+        predictions = functional_call(model, (params, buffers), (features,))
+        losses = F.cross_entropy(predictions, labels, reduction='none')
+        return torch.sum(losses * mask) / torch.clamp(torch.sum(mask), min=1)
+
+    per_client_grad = vmap(grad(batch_loss), in_dims=(None, 0, 0, 0), randomness='different')
+
+    flat_grads = []
+    for start in range(0, len(training_sets), chunk_size):
+        iterators = [iter(dl) for dl in training_sets[start:start + chunk_size]]
+        accumulated_grad = None
+        previous_mean = None
+        batch_count = torch.zeros(len(iterators), device=next(iter(params.values())).device)
+
+        while True:
+            batches = [next(it, None) if it is not None else None for it in iterators]
+            if all(b is None for b in batches):
+                break
+
+            features, labels, mask = _stack_client_batches(batches)
+            grads = per_client_grad(params, features, labels, mask)
+            flat = torch.cat([g.flatten(1) for g in grads.values()], dim=1)  # [C, P]
+
+            accumulated_grad = flat if accumulated_grad is None else accumulated_grad + flat
+            batch_count += (mask.sum(dim=1) > 0).to(batch_count.dtype)
+
+            if tol is not None:
+                mean = accumulated_grad / batch_count.clamp(min=1)[:, None]
+                if previous_mean is not None:
+                    converged = _probe_converged(mean, previous_mean, tol).tolist()
+                    for c, batch in enumerate(batches):
+                        if batch is not None and converged[c]:
+                            iterators[c] = None
+                previous_mean = mean
+
+        flat_grads.extend(accumulated_grad / batch_count.clamp(min=1)[:, None])
+        if batch_counts is not None:
+            batch_counts.extend(int(n) for n in batch_count.tolist())
+
+    return flat_grads
+
+def train_clients_batched(model, streams: list, mu: float, n_SGD: int, lr: float):
+    """
+    n_SGD local FedProx SGD steps of several clients at once, all starting from the
+    parameters of `model`.
+    The clients' parameters are stacked along a leading client dimension and trained
+    with one vmapped forward/backward pass per step: every client draws its next batch
+    from its own stream of `streams` (batches are padded and masked to a common size),
+    takes its own plain SGD step with the proximal gradient mu * (w - w0) added as in
+    FedProxSGD. For dropout-free models the result matches local_learning client by
+    client up to float rounding; with dropout (CNN_CIFAR10_dropout) the masks are drawn
+    differently under vmap, so it only matches in distribution.
+    Returns the trained flat parameters as a [len(streams), n_params] tensor.
+    """
+    w0 = {name: param.detach() for name, param in model.named_parameters()}
+    buffers = {name: buf.detach() for name, buf in model.named_buffers()}
+    params = {name: param.unsqueeze(0).repeat(len(streams), *([1] * param.dim()))
+              for name, param in w0.items()}
+
+    def client_loss(params, features, labels, mask):
+        predictions = functional_call(model, (params, buffers), (features,))
+        losses = F.cross_entropy(predictions, labels, reduction='none')
+        return torch.sum(losses * mask) / torch.clamp(torch.sum(mask), min=1)
+
+    client_grads = vmap(grad(client_loss), randomness='different')
+
+    for _ in range(n_SGD):
+        features, labels, mask = _stack_client_batches([next(stream) for stream in streams])
+        grads = client_grads(params, features, labels, mask)
+        for name in params:
+            if mu != 0:
+                grads[name].add_(params[name] - w0[name], alpha=mu)
+            params[name].sub_(grads[name], alpha=lr)
+
+    return torch.cat([param.flatten(1) for param in params.values()], dim=1)
+
+def probe_batches(train_data, k, round_idx=0, mode=None, max_batches=None):
+    """
+    Batches of client k's `train_data` its gradient probe averages over (config.PROBE_MODE):
+    the whole loader for 'full', otherwise at most `max_batches` distinct batches of a
+    BatchStream, the same ones every round for 'fixed' and redrawn from (k, round_idx)
+    for 'random' and 'adaptive'
+    """
+    if mode is None:
+        mode = config.PROBE_MODE
+    if max_batches is None:
+        max_batches = config.PROBE_MAX_BATCHES
+
+    if mode == 'full':
+        return train_data
+    if mode == 'fixed':
+        seed = k
+    elif mode in ('random', 'adaptive'):
+        seed = (k, round_idx)
+    else:
+        raise ValueError(f"Unknown probe mode: {mode}")
+
+    stream = BatchStream(train_data.dataset, train_data.batch_size, seed=seed, prefetch=0)
+    return islice(stream, min(max_batches, stream.n_batches))
+
+def collect_compressed_gradients(model, training_sets, d_prime, clients=None, round_idx=0, batches_used=None):
     """
     Collect compressed gradients from all clients
     Args:
         model: global model
         training_sets: list of training datasets
         d_prime: compression parameter
+        clients: client ids of `training_sets` (defaults to their positions)
+        round_idx: round of the probe, seeds the 'random' and 'adaptive' probe batches
+        batches_used: optional list the number of batches probed per client is appended to
     Returns:
-        all_compressed_grads: compressed gradients from all clients
-        all_indices: indices for each client's compressed gradients
+        all_compressed_grads: codebooks of all clients, as decoded by the server
+        messages: the CompressedGradient each client sent
     """
     all_compressed_grads = []
-    all_indices = []
-    
-    for client_id, train_data in enumerate(training_sets):
-        #print(f"\nClient {client_id + 1}:")
+    messages = []
 
-        # Each client computes and compresses their gradient
-        local_model = deepcopy(model)
-        compressed_grad, indices = client_compress_gradient(local_model, train_data, d_prime)
-        
-        # Server collects compressed gradients
-        all_compressed_grads.append(compressed_grad)
-        all_indices.append(indices)
-    
-    return np.array(all_compressed_grads), all_indices
+    if clients is None:
+        clients = range(len(training_sets))
+    probe_sets = [probe_batches(train_data, k, round_idx) for k, train_data in zip(clients, training_sets)]
+    tol = config.PROBE_TOL if config.PROBE_MODE == 'adaptive' else None
+
+    if config.PROBE_LAYER == 'last':
+        # Closed-form output-layer gradients: forward passes only, on the global model
+        flat_grads = (last_layer_gradient(model, train_data, tol=tol, batch_counts=batches_used)
+                      for train_data in probe_sets)
+    elif config.BATCHED_PROBE and functional_call is not None:
+        # One fused probe over all clients, no per-client model copies
+        flat_grads = batched_client_gradients(model, probe_sets, tol=tol, batch_counts=batches_used)
+    else:
+        # A single scratch copy of the global model is reused by every client
+        probe_model = deepcopy(model)
+        flat_grads = (client_gradient(probe_model, train_data, flatten=False, tol=tol, batch_counts=batches_used)
+                      for train_data in probe_sets)
+
+    for flat_grad in flat_grads:
+        # Each client compresses their gradient and packs it for the upload
+        message = CompressedGradient.encode(*compress_gradient(flat_grad, d_prime))
+
+        # Server collects the compressed gradients, stratification only needs the codebooks
+        messages.append(message)
+        all_compressed_grads.append(message.decode_codebook())
+
+    return np.array(all_compressed_grads), messages
+
+class GradientSketchCache:
+    """
+    Keeps the last compressed gradient of every client and its age in rounds, so the
+    per-round stratification does not have to probe every client every round.
+    Refresh policies (config.SKETCH_REFRESH):
+        'all'      - probe every client every round (no caching)
+        'sampled'  - probe only the clients sampled in the previous round
+        'every'    - probe every client every `refresh_every` rounds
+        'fraction' - probe a random `refresh_fraction` of the clients each round
+    The first call always probes every client. Per-round counters are kept in `history`.
+    """
+
+    def __init__(self, n_clients, policy=None, refresh_every=None, refresh_fraction=None):
+        self.n_clients = n_clients
+        self.policy = config.SKETCH_REFRESH if policy is None else policy
+        self.refresh_every = config.SKETCH_REFRESH_EVERY if refresh_every is None else refresh_every
+        self.refresh_fraction = config.SKETCH_REFRESH_FRACTION if refresh_fraction is None else refresh_fraction
+
+        self.compressed_grads = None
+        self.messages = [None] * n_clients
+        self.age = np.zeros(n_clients, dtype=int)
+        self.history = []
+
+    def clients_to_refresh(self, round_idx, last_sampled):
+        if self.compressed_grads is None or self.policy == 'all':
+            return np.arange(self.n_clients)
+        if self.policy == 'sampled':
+            return np.unique(np.asarray(last_sampled, dtype=int))
+        if self.policy == 'every':
+            if round_idx % self.refresh_every == 0:
+                return np.arange(self.n_clients)
+            return np.array([], dtype=int)
+        if self.policy == 'fraction':
+            n_refresh = int(np.ceil(self.refresh_fraction * self.n_clients))
+            return np.sort(np.random.choice(self.n_clients, n_refresh, replace=False))
+        raise ValueError(f"Unknown sketch refresh policy: {self.policy}")
+
+    def refresh(self, model, training_sets, d_prime, round_idx, last_sampled=(), ledger=None):
+        """
+        Re-probe the clients selected by the refresh policy with the current global model
+        and return the compressed gradients and last messages of all clients, like
+        collect_compressed_gradients. The probe traffic is recorded in `ledger` if given
+        """
+        refresh = self.clients_to_refresh(round_idx, last_sampled)
+
+        self.age += 1
+        batches_used = []
+        messages = []
+        if len(refresh) > 0:
+            compressed_grads, messages = collect_compressed_gradients(
+                model, [training_sets[k] for k in refresh], d_prime,
+                clients=refresh, round_idx=round_idx, batches_used=batches_used)
+            if self.compressed_grads is None:
+                self.compressed_grads = np.zeros((self.n_clients, compressed_grads.shape[1]))
+            self.compressed_grads[refresh] = compressed_grads
+            for k, message in zip(refresh, messages):
+                self.messages[k] = message
+            if ledger is not None:
+                ledger.broadcast(round_idx, refresh)
+                ledger.record('probe', round_idx, refresh, [message.nbytes for message in messages])
+            self.age[refresh] = 0
+
+        stats = {
+            'round': round_idx,
+            'refreshed': len(refresh),
+            'hit_rate': 1 - len(refresh) / self.n_clients,
+            'mean_staleness': float(np.mean(self.age)),
+            'max_staleness': int(np.max(self.age)),
+            # batches each refreshed client's probe used, 0 for the cached clients
+            'batches_used': np.zeros(self.n_clients, dtype=int),
+            # bytes uploaded by the probed clients
+            'probe_bytes': sum(message.nbytes for message in messages),
+        }
+        stats['batches_used'][refresh] = batches_used
+        self.history.append(stats)
+        print(f"Sketch cache - refreshed: {stats['refreshed']}, hit rate: {stats['hit_rate']:.2f}, "
+              f"staleness mean: {stats['mean_staleness']:.2f} max: {stats['max_staleness']}")
+        if len(refresh) > 0:
+            print(f"Probe batches per client - mean: {np.mean(batches_used):.1f}, "
+                  f"min: {np.min(batches_used)}, max: {np.max(batches_used)}")
+            print(f"Probe upload: {stats['probe_bytes']} bytes ({stats['probe_bytes'] / len(refresh):.0f} per client)")
+
+        return self.compressed_grads, self.messages
+
+class CommLedger:
+    """
+    Bytes exchanged with every client in every round, per message type:
+        'broadcast'   - download of the global model, once per client and round
+        'probe'       - upload of the client's CompressedGradient
+        'dp_response' - upload of the client's randomized size answer to the Estimator
+        'update'      - upload of the client's locally trained model
+    `bytes[message]` is an (n_iter, K) array. The simulated evaluation of every client
+    is measurement, not protocol, and is not counted.
+    """
+    DOWNLOAD = ('broadcast',)
+    UPLOAD = ('probe', 'dp_response', 'update')
+
+    def __init__(self, model, n_clients, n_iter):
+        self.model_bytes = sum(param.numel() * param.element_size() for param in model.parameters())
+        self.bytes = {message: np.zeros((n_iter, n_clients), dtype=np.int64)
+                      for message in self.DOWNLOAD + self.UPLOAD}
+
+    def record(self, message, round_idx, clients, nbytes):
+        """Add `nbytes` (one value, or one per client) to `clients`, who may repeat"""
+        clients = np.asarray(clients, dtype=int)
+        np.add.at(self.bytes[message][round_idx], clients, np.broadcast_to(nbytes, clients.shape))
+
+    def broadcast(self, round_idx, clients):
+        """The global model of round `round_idx` is sent to each of `clients` at most once"""
+        self.bytes['broadcast'][round_idx, np.asarray(clients, dtype=int)] = self.model_bytes
+
+    def record_training(self, round_idx, clients):
+        """Broadcast of the global model to, and model update from, every trained client"""
+        self.broadcast(round_idx, clients)
+        self.record('update', round_idx, clients, self.model_bytes)
+
+    def totals(self, messages):
+        """Bytes of `messages` summed over the clients, per round"""
+        return sum(self.bytes[message].sum(axis=1) for message in messages)
+
+    def summary(self):
+        upload, download = self.totals(self.UPLOAD).sum(), self.totals(self.DOWNLOAD).sum()
+        per_message = ", ".join(f"{message}: {self.bytes[message].sum() / 2**20:.2f}" for message in self.bytes)
+        print(f"Communication - upload: {upload / 2**20:.2f} MB, download: {download / 2**20:.2f} MB ({per_message})")
+
+class RoundTimer:
+    """
+    Wall-clock and process CPU time of every stage of every round of a training run.
+    Row 0 of `wall`/`cpu` is the setup before the first round (initial evaluation, one-off
+    probes) and row r + 1 is round r, like the rows of loss_hist. Stages may nest: a stage
+    is charged its own time only, without the stages timed inside it. CPU time is the
+    time of this process (all its threads), not of forked training workers.
+    With `trace`, every stage is also kept as a Chrome trace event (chrome://tracing,
+    Perfetto), saved by save().
+    """
+    STAGES = ('probe', 'stratify', 'allocate', 'sample', 'train', 'aggregate', 'evaluate')
+
+    def __init__(self, n_iter, trace=None):
+        self.trace = config.TIMING_TRACE if trace is None else trace
+        self.wall = np.zeros((n_iter + 1, len(self.STAGES)))
+        self.cpu = np.zeros((n_iter + 1, len(self.STAGES)))
+        self.events = []
+        self._children = []  # wall and CPU time of the stages nested in each open stage
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, row):
+        column = self.STAGES.index(name)
+        self._children.append([0.0, 0.0])
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            child_wall, child_cpu = self._children.pop()
+            self.wall[row, column] += wall - child_wall
+            self.cpu[row, column] += cpu - child_cpu
+            if self._children:
+                self._children[-1][0] += wall
+                self._children[-1][1] += cpu
+            if self.trace:
+                self.events.append({
+                    'name': name, 'cat': 'round', 'ph': 'X', 'pid': 0, 'tid': 0,
+                    'ts': (wall_start - self._origin) * 1e6, 'dur': wall * 1e6,
+                    'args': {'row': row, 'cpu_ms': cpu * 1e3},
+                })
+
+    def summary(self):
+        totals = self.wall.sum(axis=0)
+        print("Timing (wall s) - " + ", ".join(f"{name}: {total:.2f}" for name, total in zip(self.STAGES, totals)))
+
+    def save(self, file_name):
+        save_pkl({'stages': self.STAGES, 'wall': self.wall, 'cpu': self.cpu}, "timing", file_name)
+        if self.trace:
+            with open(f"saved_exp_info/timing/{file_name}.trace.json", 'w') as output:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, output)
 
 def stratify_clients(args):
     partition_result_path = f"dataset/data_partition_result/{args.dataset}_{args.partition}.pkl"
@@ -156,15 +825,8 @@ def stratify_clients(args):
     model = KMeans(n_clusters=args.strata_num)
     model.fit(data)
     pred_y = model.predict(data)
-    pred_y= list(pred_y)
-    result = []
     # put indexes into result
-    for num in range(args.strata_num):
-        one_type = []
-        for index, value in enumerate(pred_y):
-            if value==num:
-                one_type.append(index)
-        result.append(one_type)
+    result = strata_from_labels(pred_y, args.strata_num)
     print(result)
     save_path = f'dataset/stratify_result/{args.dataset}_{args.partition}.pkl'
     # os.makedirs(os.path.dirname(save_path), exist_ok=True)
@@ -177,38 +839,184 @@ def stratify_clients(args):
     # silhouette score ranges from -1 to 1, higher values indicate better-defined clusters
     return result
 
+def strata_from_labels(labels, n_strata):
+    """Client indices of every stratum, from one stable argsort and bincount of the labels"""
+    labels = np.asarray(labels, dtype=int)
+    order = np.argsort(labels, kind='stable')
+    counts = np.bincount(labels, minlength=n_strata)
+    return [members.tolist() for members in np.split(order, np.cumsum(counts)[:-1])]
+
+class IncrementalStratifier:
+    """
+    K-means stratification of the client sketches carried over from round to round.
+    The first round runs a full KMeans fit; later rounds warm-start from the previous
+    centroids and run at most `max_iter` Lloyd iterations, so stratum h keeps meaning
+    the same group of clients over time. An empty stratum keeps its previous centroid.
+    """
+
+    def __init__(self, n_strata, max_iter=None):
+        self.n_strata = n_strata
+        self.max_iter = config.STRATIFY_MAX_ITER if max_iter is None else max_iter
+        self.centroids = None
+        self.labels = None
+        self.churn = 0.0
+
+    def _lloyd(self, data, centroids):
+        data_sq = np.sum(data ** 2, axis=1, keepdims=True)
+        for _ in range(self.max_iter):
+            dist = data_sq - 2 * data @ centroids.T + np.sum(centroids ** 2, axis=1)
+            labels = np.argmin(dist, axis=1)
+
+            counts = np.bincount(labels, minlength=self.n_strata)
+            sums = np.stack([np.bincount(labels, weights=column, minlength=self.n_strata)
+                             for column in data.T], axis=1)
+            new_centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids)
+
+            converged = np.allclose(new_centroids, centroids)
+            centroids = new_centroids
+            if converged:
+                break
+
+        dist = data_sq - 2 * data @ centroids.T + np.sum(centroids ** 2, axis=1)
+        return centroids, np.argmin(dist, axis=1)
+
+    def fit_predict(self, data):
+        data = np.asarray(data, dtype=float)
+        if self.centroids is None or self.centroids.shape[1] != data.shape[1]:
+            model = KMeans(n_clusters=self.n_strata)
+            labels = model.fit_predict(data)
+            centroids = model.cluster_centers_
+        else:
+            centroids, labels = self._lloyd(data, self.centroids)
+
+        if self.labels is not None and len(self.labels) == len(labels):
+            # fraction of the clients that moved to another stratum since last round
+            self.churn = float(np.mean(self.labels != labels))
+        self.centroids = centroids
+        self.labels = labels
+        return labels
+
 def save_pkl(dictionnary, directory, file_name):
     """Save the dictionnary in the directory under the file_name with pickle"""
     with open(f"saved_exp_info/{directory}/{file_name}.pkl", "wb") as output:
         pickle.dump(dictionnary, output)
 
-def sample_clients_without_allocation(chosen_p, choice_num):
-    n_clients = len(chosen_p[0])
-    strata_num = len(chosen_p)
+def sample_clients_stratified(strata, client_weights, allocation_number, rng=None):
+    """
+    Weighted sampling without replacement inside every stratum, all strata in one pass.
+    strata: list of client index arrays, one per stratum
+    client_weights: weight of every client of the population; within a stratum clients are
+        drawn with probability proportional to their weight (uniformly if the whole stratum
+        has zero weight)
+    allocation_number: number of clients to draw from each stratum, or one number for all
+    Every client gets the key log(weight) + Gumbel noise and the allocation_number[h] largest
+    keys of stratum h are kept (Gumbel top-k), which has the same distribution as drawing
+    the clients one at a time without replacement. Zero-weight clients of a stratum are
+    only drawn once its positive-weight clients are exhausted, and a stratum never gives
+    more clients than it holds.
+    rng: np.random.Generator to draw from, the global NumPy RNG if None
+    Returns the sampled client indices, stratum by stratum.
+    """
+    n_strata = len(strata)
+    sizes = np.array([len(stratum) for stratum in strata], dtype=int)
+    if np.sum(sizes) == 0:
+        return []
+
+    members = np.concatenate([np.asarray(stratum, dtype=int) for stratum in strata])
+    stratum_of = np.repeat(np.arange(n_strata), sizes)
+
+    weights = np.asarray(client_weights, dtype=float)[members]
+    stratum_weight = np.bincount(stratum_of, weights=weights, minlength=n_strata)
+    weights = np.where(stratum_weight[stratum_of] > 0, weights, 1.0)
+
+    with np.errstate(divide='ignore'):
+        keys = np.log(weights) + (np.random if rng is None else rng).gumbel(size=len(weights))
 
-    sampled_clients = np.zeros(len(chosen_p) * choice_num, dtype=int)
+    # sort by stratum, then by decreasing key, and keep the first m_h of every stratum
+    order = np.lexsort((-keys, stratum_of))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    rank = np.arange(len(order)) - starts[stratum_of[order]]
+    n_draws = np.minimum(np.broadcast_to(np.asarray(allocation_number, dtype=int), n_strata), sizes)
+    chosen = order[rank < n_draws[stratum_of[order]]]
 
-    for k in range(strata_num):
-        c = choice(n_clients, choice_num, replace=False, p=chosen_p[k])
-        for n_th, one_choice in enumerate(c):
-            sampled_clients[k * choice_num + n_th] = int(one_choice)
+    return members[chosen].tolist()
 
-    return sampled_clients
+def _strata_from_chosen_p(chosen_p):
+    chosen_p = np.asarray(chosen_p, dtype=float)
+    strata = [np.flatnonzero(row) for row in chosen_p]
+    return strata, chosen_p.max(axis=0)
+
+def sample_clients_without_allocation(chosen_p, choice_num):
+    strata, client_weights = _strata_from_chosen_p(chosen_p)
+    return np.array(sample_clients_stratified(strata, client_weights, choice_num), dtype=int)
 
 def sample_clients_with_allocation(chosen_p, allocation_number):
-    n_clients = len(chosen_p[0])
+    strata, client_weights = _strata_from_chosen_p(chosen_p)
+    return sample_clients_stratified(strata, client_weights, allocation_number)
+
+def stratum_spread(points, max_exact=None, eps=None, delta=None):
+    """
+    S_h of a stratum: the sum over clients j of the summed Euclidean distance to every
+    other client k, divided by N_h twice, i.e. sum_{j != k} ||x_j - x_k|| / N_h^2.
+    Up to `max_exact` clients the distances are computed exactly, block by block.
+    Larger strata use the mean distance of m = ceil(ln(2 / delta) / (2 eps^2)) random
+    client pairs: by Hoeffding's inequality the estimate is within eps * D of the exact
+    value with probability at least 1 - delta, where D is the diameter of the stratum.
+    """
+    if max_exact is None:
+        max_exact = config.NEYMAN_EXACT_MAX
+    if eps is None:
+        eps = config.NEYMAN_EPS
+    if delta is None:
+        delta = config.NEYMAN_DELTA
 
-    sampled_clients = []
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n < 2:
+        # If only one client in the stratum, variability is 0
+        return 0.0
+    points = points.reshape(n, -1)
 
-    for i, n in enumerate(allocation_number):
-        if n == 0:
-            pass
-        else:
-            c = choice(n_clients, n, replace=False, p=chosen_p[i])
-            for n_th, one_choice in enumerate(c):
-                sampled_clients.append(int(one_choice))
+    if n <= max_exact:
+        block = max(1, 2 ** 22 // n)
+        total = 0.0
+        for start in range(0, n, block):
+            total += np.sum(cdist(points[start:start + block], points))
+        return total / n ** 2
+
+    n_pairs = int(np.ceil(np.log(2 / delta) / (2 * eps ** 2)))
+    j = np.random.randint(n, size=n_pairs)
+    k = np.random.randint(n - 1, size=n_pairs)
+    k += k >= j  # uniform over k != j
+    mean_dist = np.mean(np.sqrt(np.sum((points[j] - points[k]) ** 2, axis=1)))
+    return mean_dist * (n - 1) / n
+
+def largest_remainder_allocation(weights, n_sample, capacity):
+    """
+    Split n_sample into integers proportional to `weights` (largest-remainder method).
+    Every stratum first gets the floor of its quota, then the leftover units go one by one
+    to the largest fractional remainders, ties broken by stratum index. No stratum gets
+    more than its `capacity` (N_h).
+    """
+    weights = np.asarray(weights, dtype=float)
+    capacity = np.asarray(capacity, dtype=int)
+    if np.sum(weights) <= 0 or n_sample <= 0:
+        return np.zeros(len(weights), dtype=int)
+
+    quotas = n_sample * weights / np.sum(weights)
+    allocation_number = np.minimum(np.floor(quotas).astype(int), capacity)
+    order = np.argsort(-(quotas - np.floor(quotas)), kind='stable')
+
+    leftover = n_sample - np.sum(allocation_number)
+    while leftover > 0:
+        open_strata = order[allocation_number[order] < capacity[order]]
+        if len(open_strata) == 0:
+            break
+        receivers = open_strata[:leftover]
+        allocation_number[receivers] += 1
+        leftover -= len(receivers)
 
-    return sampled_clients
+    return allocation_number
 
 def cal_allocation_number(partition_result, stratify_result, sample_ratio):
     """
@@ -223,9 +1031,10 @@ def cal_allocation_number(partition_result, stratify_result, sample_ratio):
         Each sublist corresponds to a stratum, with each element being an individual client.
     :param sample_ratio: A float representing the ratio of the total sample size to
         the entire population size, used to determine the proportional allocation numbers.
-    :return: A numpy array containing the integer allocation number for each stratum, where
-        the sum of all allocation numbers equals approximately the specified sample ratio
-        multiplied by 100.
+    :return: A list containing the integer allocation number for each stratum, proportional
+        to N_h * S_h and rounded by the largest-remainder method, so that the allocation
+        numbers sum to floor(sample_ratio * N) for the N clients of all strata (less only
+        if the strata are too small to hold them).
     """
     #Below is commented out because it is not used in the current implementation
     '''
@@ -275,155 +1084,258 @@ def cal_allocation_number(partition_result, stratify_result, sample_ratio):
         return [0] * len(stratify_result)
 
     # 3) Compute (N_h, S_h) for each stratum
-    Nh_list = [len(stratum) for stratum in stratify_result]
-    Sh_list = []
-
-    for stratum in stratify_result:
-        if len(stratum) < 2:
-            # If only one client in the stratum, variability is 0
-            Sh_list.append(0.0)
-        else:
-            # Example: average pairwise distances of 'compressed_grads'
-            dist = np.zeros(len(stratum), dtype=float)
-            for j in range(len(stratum)):
-                for k in range(len(stratum)):
-                    if k != j:
-                        diff = compressed_grads[stratum[j]] - compressed_grads[stratum[k]]
-                        dist[j] += np.sqrt(np.sum(diff * diff))
-            dist /= len(stratum)
-            # S_h = average of dist
-            S_h = np.mean(dist)
-            Sh_list.append(S_h)
+    # S_h: average pairwise Euclidean distance of the clients' partition vectors
+    partition_result = np.asarray(partition_result, dtype=float)
+    Nh_list = np.array([len(stratum) for stratum in stratify_result])
+    Sh_list = np.array([stratum_spread(partition_result[np.asarray(stratum, dtype=int)])
+                        for stratum in stratify_result])
 
     # 4) Weights = N_h * S_h
-    weights = [Nh * Sh for Nh, Sh in zip(Nh_list, Sh_list)]
-    total_weight = sum(weights)
+    weights = Nh_list * Sh_list
 
     # Edge case: if total_weight == 0, either all strata have single client or no variability
-    if total_weight == 0:
-        # Just distribute m evenly or put them in the first stratum
-        # Example: all strata get the same share or at least 1 for the first
-        # For simplicity, let's do a uniform distribution
-        uniform_alloc = [0] * len(stratify_result)
-        for i in range(m):
-            uniform_alloc[i % len(stratify_result)] += 1
-        return uniform_alloc
-
-    # 5) Proportional allocation with floor
-    allocation_number = []
-    fractional_parts = []
-    for w in weights:
-        raw = (w / total_weight) * m
-        int_alloc = floor(raw)
-        allocation_number.append(int_alloc)
-        fractional_parts.append(raw - int_alloc)
-
-    current_sum = sum(allocation_number)
-    diff = m - current_sum
-
-    # 6) If sum(allocation_number) < m, we have leftover to distribute
-    if diff > 0:
-        # Sort strata by largest fractional remainder
-        remainder_indices = sorted(
-            range(len(allocation_number)),
-            key=lambda i: fractional_parts[i],
-            reverse=True
-        )
-        # Distribute +1 to the top 'diff' strata
-        for i in range(diff):
-            allocation_number[remainder_indices[i]] += 1
-
-    # If diff < 0 (less likely since we used floor), you'd remove some from the smallest fractional remainders
+    if np.sum(weights) == 0:
+        # For simplicity, let's do a uniform distribution over the non-empty strata
+        weights = (Nh_list > 0).astype(float)
 
+    # 5) Proportional allocation with floor, leftover to the largest fractional remainders
     # At this point sum(allocation_number) == m
-    return allocation_number
+    return largest_remainder_allocation(weights, m, Nh_list).tolist()
 
 def cal_allocation_number_NS(stratify_result, compressed_grads, stratum_size, sample_ratio):
     """
-
+    Neyman allocation m_h ∝ N_h * S_h of the sample_ratio * N sampled clients, where S_h is
+    the average pairwise Euclidean distance between the compressed gradients of stratum h.
+    Large strata (more than config.NEYMAN_EXACT_MAX clients) use the sampled-pairs estimate
+    of S_h. Returns an integer array with one allocation number per stratum.
     """
-    Nh_list = stratum_size
-    cohesion_list = []
-
-    for row_strata in stratify_result:
-        dist = np.zeros(len(row_strata))
-
-        for j in range(len(row_strata)):
-            for k in range(len(row_strata)):
-                if k == j:
-                    pass
-                else:
-                    dist[j] += np.sqrt(np.sum(np.square(compressed_grads[row_strata[j]] - compressed_grads[row_strata[k]])))
-                    #sum of Euclidean distances between each client and all other clients in the same stratum
-        dist /= len(row_strata) # each row is a stratum
-        cohesion_list.append(dist)
-
-    Sh_list = np.zeros(len(cohesion_list))
-    for i, strata_cohesion in enumerate(cohesion_list):
-        Sh_list[i] = sum(strata_cohesion) / len(strata_cohesion)
+    compressed_grads = np.asarray(compressed_grads, dtype=float)
+    Nh_list = np.asarray(stratum_size)
 
-    neyman_weights = [nh * sh for nh, sh in zip(Nh_list, Sh_list)]
-    total_weight = sum(neyman_weights)
+    Sh_list = np.array([stratum_spread(compressed_grads[np.asarray(row_strata, dtype=int)])
+                        for row_strata in stratify_result])
 
-    allocation_number = np.zeros(len(neyman_weights))
-    for i, weight in enumerate(neyman_weights):
-        allocation_number[i] = floor(sample_ratio * 100 * weight /  total_weight)
+    neyman_weights = Nh_list * Sh_list
+    if np.sum(neyman_weights) == 0:
+        # no variability anywhere: spread the sample uniformly over the non-empty strata
+        neyman_weights = (Nh_list > 0).astype(float)
 
-    allocation_number = allocation_number.astype(int)
-
-    zero_num = (allocation_number == 0).sum()
-    i = 0
-    while np.sum(allocation_number) < sample_ratio * 100:
-        if allocation_number[i] == 0:
-            allocation_number[i] += max(1, int(round((sample_ratio * 100 - np.sum(allocation_number)) / zero_num)))
-        i += 1
+    n_sample = floor(sample_ratio * np.sum(Nh_list))
+    allocation_number = largest_remainder_allocation(neyman_weights, n_sample, Nh_list)
 
     return allocation_number
 
 class Estimator:
-    def __init__(self,train_users,alpha,M):
+    """
+    Privacy-preserving estimate of the total number of samples (FedSampling).
+    Every user answers its sample count clipped at M - 1 with probability alpha and a
+    uniform fake count in [1, M - 1] otherwise; hat_N inverts the expected answer sum.
+    All the answers of a round come from one Generator call, and estimate_rounds draws
+    several rounds at once in chunks of at most chunk_size random numbers.
+    seed: seed of the estimator's Generator, drawn from the global NumPy RNG if None so
+        that runs stay reproducible under np.random.seed
+    """
+    def __init__(self,train_users,alpha,M,seed=None,chunk_size=2**22):
         self.M = M
         self.alpha = alpha
         self.train_users = train_users
+        self.chunk_size = chunk_size
+        if seed is None:
+            seed = np.random.randint(2**31)
+        self.rng = np.random.default_rng(seed)
+
+        n_users = len(train_users)
+        sizes = np.fromiter((len(train_users[uid]) for uid in range(n_users)),
+                            dtype=np.int64, count=n_users)
+        self.real_responses = np.minimum(sizes, self.M - 1)
+        # size of one answer in [1, M - 1] on the wire
+        self.response_bytes = np.min_scalar_type(self.M - 1).itemsize
         
     def query(self,userid):
-        fake_response = np.random.randint(1,self.M)
-        real_response = min(len(self.train_users[userid]), self.M - 1)
-        #real_response = len(self.train_users[userid])
-        choice = np.random.binomial(n=1,p=self.alpha)
-        response = choice*real_response + (1-choice)*fake_response
+        fake_response = self.rng.integers(1,self.M)
+        real_response = self.real_responses[userid]
+        keep = self.rng.random() < self.alpha
+        response = real_response if keep else fake_response
         return response
+
+    def _responses_sum(self, n_rounds):
+        # u[0] < alpha picks the real answer, u[1] maps to a fake answer in [1, M - 1]
+        u = self.rng.random((2, n_rounds, len(self.real_responses)))
+        fake = 1 + np.floor(u[1] * (self.M - 1))
+        responses = np.where(u[0] < self.alpha, self.real_responses, fake)
+        return responses.sum(axis=1)
+
+    def _hat_N(self, R):
+        n_users = len(self.real_responses)
+        hat_N = (R-n_users*(1-self.alpha)*self.M/2)/self.alpha
+        return np.maximum(hat_N, n_users)
     
     def estimate(self,):
-        R = 0
-        for uid in range(len(self.train_users)):
-            R += self.query(uid)
-        hat_N =  (R-len(self.train_users)*(1-self.alpha)*self.M/2)/self.alpha
-        hat_N = max(hat_N,len(self.train_users))
-        return hat_N
+        return float(self._hat_N(self._responses_sum(1))[0])
+
+    def estimate_rounds(self, n_rounds):
+        """Independent hat_N for n_rounds rounds, as an array."""
+        per_chunk = max(1, self.chunk_size // (2 * max(len(self.real_responses), 1)))
+        R = np.concatenate([self._responses_sum(min(per_chunk, n_rounds - start))
+                            for start in range(0, n_rounds, per_chunk)])
+        return self._hat_N(R)
     
 def local_data_sampling(dataset,K_desired,hatN):
+    """
+    Keep every sample of a client independently with probability min(K_desired / hatN, 1).
+    dataset: DataLoader or ClientShard of the client, or its dataset
+    Only indices are drawn: the result is a Subset view over the storage the client's
+    dataset already points to (nested Subsets are collapsed into one index array), so no
+    sample is decoded or copied. Returns None if no sample is kept.
+    """
     psample = K_desired/hatN
     psample = min(psample, 1.0)
     #print(f"Sample probability: {psample}")
-    sampled_features = []
-    sampled_labels = []
-    for features, labels in dataset:
-        
-        sample_mask = np.random.binomial(n=1, p=psample, size=len(features))
-        
-       
-        selected_features = features[sample_mask == 1]
-        selected_labels = labels[sample_mask == 1]
-        
-        if len(selected_features) > 0:
-            sampled_features.append(selected_features)
-            sampled_labels.append(selected_labels)
-    
-    
-    if sampled_features:
-        sampled_features = torch.cat(sampled_features)
-        sampled_labels = torch.cat(sampled_labels)
-        return sampled_features, sampled_labels
-    else:
-        return None, None
+    data = dataset.dataset if isinstance(dataset, (torch.utils.data.DataLoader, ClientShard)) else dataset
+
+    sample_mask = np.random.binomial(n=1, p=psample, size=len(data))
+    selected = np.flatnonzero(sample_mask)
+    if len(selected) == 0:
+        return None
+
+    while isinstance(data, torch.utils.data.Subset):
+        selected = np.asarray(data.indices)[selected]
+        data = data.dataset
+    return torch.utils.data.Subset(data, selected.tolist())
+
+def fetch_batch(dataset, indices):
+    """
+    Collate the samples `indices` of `dataset` into one batch.
+    Subsets are resolved to indices of the dataset they wrap, and a TensorDataset is
+    sliced directly instead of being indexed sample by sample.
+    """
+    indices = np.asarray(indices)
+    while isinstance(dataset, torch.utils.data.Subset):
+        indices = np.asarray(dataset.indices)[indices]
+        dataset = dataset.dataset
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        index = torch.from_numpy(indices).to(dataset.tensors[0].device)
+        return [tensor[index] for tensor in dataset.tensors]
+    return default_collate([dataset[int(i)] for i in indices])
+
+class BatchStream:
+    """
+    Endless stream of mini-batches over a dataset, cycling through epochs.
+    Epoch e visits the samples in the order of a permutation drawn from (seed, e), so the
+    batch at a given position of the stream is fixed: seek(position) resumes a stream
+    anywhere, e.g. in another process. With prefetch > 0 a background thread prepares
+    the next `prefetch` batches while the current one is used; close() stops it and
+    the stream restarts it on the next batch.
+    """
+
+    def __init__(self, dataset, batch_size: int, seed=0, position: int = 0, prefetch=None):
+        if prefetch is None:
+            prefetch = config.BATCH_PREFETCH
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.seed = [int(s) for s in np.atleast_1d(seed)]
+        self.prefetch = prefetch
+        self.position = position
+
+        self.n_batches = max(1, -(-len(dataset) // batch_size))
+        self._epoch, self._order = None, None
+        self._thread, self._queue, self._stop = None, None, None
+
+    def _indices(self, position):
+        epoch, offset = divmod(position, self.n_batches)
+        if epoch != self._epoch:
+            rng = np.random.default_rng(self.seed + [epoch])
+            self._epoch, self._order = epoch, rng.permutation(len(self.dataset))
+        return self._order[offset * self.batch_size:(offset + 1) * self.batch_size]
+
+    def _produce(self, position, batches, stop):
+        while not stop.is_set():
+            try:
+                batch = fetch_batch(self.dataset, self._indices(position))
+            except Exception as error:
+                batches.put(error)
+                return
+            batches.put(batch)
+            position += 1
+
+    def seek(self, position: int):
+        if position != self.position:
+            self.close()
+            self.position = position
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.prefetch <= 0:
+            batch = fetch_batch(self.dataset, self._indices(self.position))
+        else:
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._queue = queue.Queue(self.prefetch)
+                self._thread = threading.Thread(
+                    target=self._produce, args=(self.position, self._queue, self._stop), daemon=True
+                )
+                self._thread.start()
+            batch = self._queue.get()
+            if isinstance(batch, Exception):
+                self.close()
+                raise batch
+        self.position += 1
+        return batch
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        # unblock the producer if it waits on a full queue
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self._thread, self._queue, self._stop = None, None, None
+
+class ClientShard:
+    """
+    The data of one client materialized as contiguous tensors, possibly on the GPU.
+    Iterates like the DataLoader it replaces, with the same batch size and a reshuffle at
+    every pass if that loader shuffled, but a batch is a slice of the stored tensors
+    instead of a collation of single samples. `dataset` is a TensorDataset over the same
+    storage, so len(dl.dataset), BatchStream and local_data_sampling work unchanged.
+    """
+
+    def __init__(self, features, labels, batch_size: int, shuffle: bool = False):
+        self.dataset = torch.utils.data.TensorDataset(features, labels)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return -(-len(self.dataset) // self.batch_size)
+
+    def __iter__(self):
+        features, labels = self.dataset.tensors
+        if self.shuffle:
+            order = torch.randperm(len(labels)).to(labels.device)
+            for start in range(0, len(labels), self.batch_size):
+                index = order[start:start + self.batch_size]
+                yield features[index], labels[index]
+        else:
+            for start in range(0, len(labels), self.batch_size):
+                yield features[start:start + self.batch_size], labels[start:start + self.batch_size]
+
+def build_client_store(loaders, device=None):
+    """
+    Materialize every client DataLoader of `loaders` once into a ClientShard.
+    Samples go through the dataset transforms a single time, so random augmentations
+    would be frozen. device defaults to the GPU with config.USE_GPU.
+    """
+    if device is None:
+        device = 'cuda' if config.USE_GPU else 'cpu'
+
+    shards = []
+    for dl in loaders:
+        features, labels = fetch_batch(dl.dataset, np.arange(len(dl.dataset)))
+        shuffle = isinstance(dl.sampler, torch.utils.data.RandomSampler)
+        shards.append(ClientShard(features.contiguous().to(device), labels.to(device), dl.batch_size, shuffle))
+    return shards